@@ -0,0 +1,78 @@
+# coding=utf-8
+
+"""
+Compare the parsing of beanstalkd `stats` and `stats-tube` replies by
+PyYAML, as beanstalkc does, and by openiobeanstalkd.parse_stats()
+
+Usage:
+
+```
+python benchmarks/bench_beanstalkd_parse.py [tubes] [repeat]
+```
+"""
+
+import os
+import sys
+import timeit
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'collectors', 'openio'))
+
+from openiobeanstalkd import parse_stats  # noqa: E402
+
+# Fast C loader when available, beanstalkc itself uses yaml.load
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def make_stats():
+    lines = ['current-jobs-urgent: 0', 'current-jobs-ready: 1234',
+             'current-jobs-reserved: 8', 'current-jobs-delayed: 0',
+             'current-jobs-buried: 2', 'job-timeouts: 0',
+             'total-jobs: 987654', 'max-job-size: 65535',
+             'current-tubes: 120', 'current-connections: 42',
+             'uptime: 1209600', 'rusage-utime: 1234.567890',
+             'rusage-stime: 4321.098765', 'version: "1.10"',
+             'id: 7c9e7e6e0e2ad7c1', 'hostname: "node-1"']
+    lines.extend('cmd-%s: %d' % (cmd, i * 1000) for i, cmd in enumerate((
+        'put', 'peek', 'peek-ready', 'peek-delayed', 'peek-buried',
+        'reserve', 'reserve-with-timeout', 'delete', 'release', 'use',
+        'watch', 'ignore', 'bury', 'kick', 'touch', 'stats', 'stats-job',
+        'stats-tube', 'list-tubes', 'list-tube-used', 'list-tubes-watched',
+        'pause-tube')))
+    return '---\n' + '\n'.join(lines) + '\n'
+
+
+def make_tube_stats(i):
+    return ('---\nname: oio-rebuild-%d\ncurrent-jobs-urgent: 0\n'
+            'current-jobs-ready: %d\ncurrent-jobs-reserved: 1\n'
+            'current-jobs-delayed: 0\ncurrent-jobs-buried: 0\n'
+            'total-jobs: %d\ncurrent-using: 3\ncurrent-waiting: 1\n'
+            'current-watching: 4\npause: 0\ncmd-delete: %d\n'
+            'cmd-pause-tube: 0\npause-time-left: 0\n' %
+            (i, i * 7, i * 1000, i * 999))
+
+
+def main():
+    tubes = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    bodies = [make_stats()] + [make_tube_stats(i) for i in range(tubes)]
+
+    for body in bodies[:2]:
+        assert yaml.load(body, Loader=Loader) == parse_stats(body)
+
+    for name, parse in (
+            ('yaml.load', lambda b: yaml.load(b, Loader=yaml.SafeLoader)),
+            ('yaml.load (C)', lambda b: yaml.load(b, Loader=Loader)),
+            ('parse_stats', parse_stats)):
+        elapsed = min(timeit.repeat(lambda: [parse(b) for b in bodies],
+                                    number=repeat, repeat=3))
+        print("%-14s %8.2f ms/cycle %8.2f us/reply" % (
+            name, elapsed / repeat * 1e3,
+            elapsed / repeat / len(bodies) * 1e6))
+    print("(1 stats and %d stats-tube replies per cycle)" % tubes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+# coding=utf-8
+
+"""
+Measure how OpenIOSDSCollector scales with the number of services
+
+A local HTTP server stands in for the proxy and for the whole rawx fleet.
+It answers `conscience/info`, `conscience/list`, `forward/stats` (meta2) and
+rawx `/stat`, with a configurable number of services, metric lines per
+service and latency injected in every stats request. For each size, one
+collector runs a first (cold) and a second (warm) cycle, and the wall time,
+the peak memory, the number of metrics published per second and the number
+of requests served by the fake cluster are reported.
+
+Each size runs in its own process, so that the peak memory of a size does
+not carry over to the next one. The peak is the one of the cycle with
+tracemalloc (Python 3), of the whole process otherwise.
+
+All the fake rawx share the address of the server, they are told apart by a
+path suffix in their address (`127.0.0.1:<port>/rawx-<n>`).
+
+Requires diamond, urllib3 and oio, like the collector itself.
+
+Usage:
+
+```
+python benchmarks/bench_sds_scale.py [--sizes 10,100,1000,5000]
+    [--lines 50] [--latency 0.005] [--threads 8]
+```
+"""
+
+import json
+import optparse
+import os
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+import resource
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'collectors', 'openio'))
+
+import openio  # noqa: E402
+
+NAMESPACE = 'BENCH'
+
+
+class FakeCluster(object):
+    """What the fake proxy and rawx answer"""
+
+    def __init__(self, rawx, meta2, lines, latency):
+        self.rawx = rawx
+        self.meta2 = meta2
+        self.lines = lines
+        self.latency = latency
+        self.requests = 0
+        self.addr = None
+
+    def services(self, srvtype):
+        if srvtype == 'rawx':
+            count, addr = self.rawx, self.addr + '/rawx-%d'
+        elif srvtype == 'meta2':
+            count, addr = self.meta2, self.addr.rsplit(':', 1)[0] + ':%d'
+        else:
+            return []
+        return [{'addr': addr % i, 'score': i % 100,
+                 'tags': {'tag.vol': '/'}}
+                for i in range(count)]
+
+    def stats(self):
+        if self.latency:
+            time.sleep(self.latency)
+        tick = int(time.time() * 10)
+        body = []
+        for i in range(self.lines):
+            if i % 3 == 2:
+                body.append('gauge cnx.%d %d' % (i, i))
+            else:
+                body.append('counter req.hits.%d %d' % (i, tick * (i + 1)))
+        body.append('config volume /var/lib/oio/sds')
+        return '\n'.join(body) + '\n'
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body, content_type='text/plain'):
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        cluster = self.server.cluster
+        cluster.requests += 1
+        url = urlparse(self.path)
+        if url.path.endswith('/conscience/info'):
+            self.reply(json.dumps(['rawx', 'meta2']), 'application/json')
+        elif url.path.endswith('/conscience/list'):
+            srvtype = parse_qs(url.query).get('type', [''])[0]
+            self.reply(json.dumps(cluster.services(srvtype)),
+                       'application/json')
+        elif url.path.endswith('/stat'):
+            self.reply(cluster.stats())
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        self.server.cluster.requests += 1
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        if self.path.startswith('/v3.0/forward/stats'):
+            self.reply(self.server.cluster.stats())
+        else:
+            self.send_error(404)
+
+
+class FakeServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def make_collector(proxy, threads):
+    openio.load_namespace_conf = lambda ns: {'proxy': proxy}
+    config = {
+        'collectors': {
+            'default': {'hostname': 'bench'},
+            'OpenIOSDSCollector': {
+                'namespaces': NAMESPACE,
+                'fs-types': 'xfs, ext4',
+                'threads': threads,
+                'interval': 10,
+                # Only measure the collector, not the file shared with
+                # the other collectors
+                'discovery-cache': '',
+            },
+        },
+    }
+    collector = openio.OpenIOSDSCollector(config=config, handlers=[])
+    collector.published = 0
+
+    def publish_metric(metric):
+        collector.published += 1
+    collector.publish_metric = publish_metric
+    return collector
+
+
+def run_cycle(collector, cluster):
+    collector.published = 0
+    cluster.requests = 0
+    if tracemalloc:
+        tracemalloc.start()
+    start = time.time()
+    collector.collect()
+    wall = time.time() - start
+    if tracemalloc:
+        peak = tracemalloc.get_traced_memory()[1] / 1024.0
+        tracemalloc.stop()
+    else:
+        # Peak of the process running this size, cold cycle included
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return wall, peak, collector.published, cluster.requests
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--sizes', default='10,100,1000,5000',
+                      help="Numbers of services (comma separated)")
+    parser.add_option('--lines', type='int', default=50,
+                      help="Metric lines per service")
+    parser.add_option('--latency', type='float', default=0.005,
+                      help="Seconds added to every stats request")
+    parser.add_option('--threads', type='int', default=8,
+                      help="Workers of the collector")
+    parser.add_option('--meta2-ratio', type='float', default=0.25,
+                      help="Share of the services which are meta2")
+    parser.add_option('--child', action='store_true',
+                      help=optparse.SUPPRESS_HELP)
+    options, _args = parser.parse_args()
+
+    if options.child:
+        run_size(int(options.sizes), options)
+        return
+    print("%d lines per service, %.1f ms latency, %d threads" % (
+        options.lines, options.latency * 1000, options.threads))
+    print("%8s %6s %10s %12s %10s %10s %10s" % (
+        'services', 'cycle', 'wall (s)', 'peak (KiB)', 'metrics',
+        'metrics/s', 'requests'))
+    sys.stdout.flush()
+    for size in options.sizes.split(','):
+        subprocess.check_call([
+            sys.executable, os.path.abspath(__file__), '--child',
+            '--sizes', size.strip(), '--lines', str(options.lines),
+            '--latency', repr(options.latency),
+            '--threads', str(options.threads),
+            '--meta2-ratio', repr(options.meta2_ratio)])
+
+
+def run_size(size, options):
+    cluster = FakeCluster(0, 0, options.lines, options.latency)
+    server = FakeServer(('127.0.0.1', 0), FakeHandler)
+    server.cluster = cluster
+    cluster.addr = '127.0.0.1:%d' % server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    cluster.meta2 = int(size * options.meta2_ratio)
+    cluster.rawx = size - cluster.meta2
+    collector = make_collector('http://' + cluster.addr, options.threads)
+    for cycle in ('cold', 'warm'):
+        wall, peak, published, requests = run_cycle(collector, cluster)
+        print("%8d %6s %10.3f %12d %10d %10d %10d" % (
+            size, cycle, wall, peak, published, published / wall,
+            requests))
+        sys.stdout.flush()
+    collector.fanout.close()
+    collector.http.clear()
+    server.shutdown()
+    server.server_close()
+
+
+if __name__ == '__main__':
+    main()
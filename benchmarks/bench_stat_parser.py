@@ -0,0 +1,117 @@
+# coding=utf-8
+
+"""
+Compare the parsing of a gridd stats body by the former split()/cast_str()
+code and by openioutils.iter_stat_lines(), then the cost of the full paths
+of the metrics, built for every metric or taken from a MetricNames
+
+Usage:
+
+```
+python benchmarks/bench_stat_parser.py [lines] [repeat]
+```
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'collectors', 'openio'))
+
+from openioutils import MetricNames, iter_stat_lines  # noqa: E402
+
+BASE = 'servers.host-1.openio.'
+
+
+def cast_str(value):
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+
+def parse_split(data, namespace, srv_type, addr):
+    metrics = []
+    for m in data.split('\n'):
+        if not m:
+            continue
+        metric_type, metric_name, metric_value = m.split(' ')
+        metric_value = cast_str(metric_value)
+        if not isinstance(metric_value, str):
+            metric_name = "%s.%s.%s.%s" % (namespace,
+                                           srv_type,
+                                           addr.replace('.', '_'),
+                                           metric_name)
+            metrics.append((metric_name, metric_value, metric_type.upper()))
+    return metrics
+
+
+def parse_stream(data, prefix, chunk_size=65536, names=None):
+    chunks = (data[i:i + chunk_size]
+              for i in range(0, len(data), chunk_size))
+    return list(iter_stat_lines(chunks, prefix, names))
+
+
+def paths_built(data, prefix):
+    return [BASE + name for name, _v, _t, _p in parse_stream(data, prefix)]
+
+
+def paths_cached(data, prefix, names):
+    return [path for _n, _v, _t, path in
+            parse_stream(data, prefix, names=names)]
+
+
+def make_body(lines):
+    body = []
+    for i in range(lines):
+        kind = i % 4
+        if kind == 0:
+            body.append('counter req.hits.M2_OP%d %d' % (i, i * 1000))
+        elif kind == 1:
+            body.append('counter req.time.M2_OP%d %d' % (i, i * 7919))
+        elif kind == 2:
+            body.append('gauge cnx.client%d %d.%d' % (i, i, i % 10))
+        else:
+            body.append('config service.%d /var/lib/oio/sds/%d' % (i, i))
+    return '\n'.join(body) + '\n'
+
+
+def main():
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    data = make_body(lines)
+    namespace, srv_type, addr = 'OPENIO', 'meta2', '10.0.0.1:6120'
+    prefix = "%s.%s.%s." % (namespace, srv_type, addr.replace('.', '_'))
+
+    # Names built from a JSON listing are unicode on Python 2
+    prefix = type(u'')(prefix)
+    names = MetricNames(BASE, prefix)
+
+    assert (parse_split(data, namespace, srv_type, addr) ==
+            [m[:3] for m in parse_stream(data, prefix)])
+    assert paths_built(data, prefix) == paths_cached(data, prefix, names)
+
+    old = min(timeit.repeat(
+        lambda: parse_split(data, namespace, srv_type, addr),
+        number=repeat, repeat=3))
+    new = min(timeit.repeat(
+        lambda: parse_stream(data, prefix), number=repeat, repeat=3))
+    built = min(timeit.repeat(
+        lambda: paths_built(data, prefix), number=repeat, repeat=3))
+    cached = min(timeit.repeat(
+        lambda: paths_cached(data, prefix, names), number=repeat, repeat=3))
+    print("%d lines, %d bodies" % (lines, repeat))
+    print("split/cast_str:   %8.2f us/body" % (old / repeat * 1e6))
+    print("iter_stat_lines:  %8.2f us/body" % (new / repeat * 1e6))
+    print("speedup:          %8.2fx" % (old / new))
+    print("paths built:      %8.2f us/body" % (built / repeat * 1e6))
+    print("paths cached:     %8.2f us/body" % (cached / repeat * 1e6))
+    print("speedup:          %8.2fx" % (built / cached))
+
+
+if __name__ == '__main__':
+    main()
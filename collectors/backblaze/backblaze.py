@@ -4,12 +4,21 @@
 Collect metrics from Backblaze API
 Targeted SDS Version: B2 support (unstable)
 
+The statistics of the buckets of `bucket-name` (comma separated) are
+fetched by a background thread every `refresh-ttl` seconds, since listing
+a large bucket takes long. Each cycle publishes the last known values, and
+their age in seconds (`<account>.<bucket>.age`). The same client, and thus
+the same authorization, is kept for `auth-ttl` seconds, or until an error.
+
 #### Dependencies
 
  * oio
 
 """
 
+import threading
+import time
+
 import diamond.collector
 from oio.api.backblaze_http import Backblaze, BackblazeException
 
@@ -20,14 +29,29 @@ class BackblazeCollector(diamond.collector.Collector):
         super(BackblazeCollector, self).process_config()
         self.application_key = self.config['application-key']
         self.account_id = self.config['account-id']
-        self.bucket_name = self.config['bucket-name']
+        buckets = self.config['bucket-name']
+        if isinstance(buckets, basestring):
+            buckets = buckets.split(',')
+        self.buckets = [b.strip() for b in buckets if b.strip()]
+        self.refresh_ttl = float(self.config['refresh-ttl'])
+        self.auth_ttl = float(self.config['auth-ttl'])
+
+        # bucket name -> (size, number, time of the fetch)
+        self.infos = {}
+        self.lock = threading.Lock()
+        self.refresher = None
+        self.backblaze = None
+        self.authorized_at = 0
 
     def get_default_config_help(self):
         config_help = super(BackblazeCollector, self).get_default_config_help()
         config_help.update({
             "account-id": "",
             "application-key": "",
-            "bucket-name": ""
+            "bucket-name": "Names of the buckets (comma separated)",
+            "refresh-ttl": "Seconds between two fetches of the statistics"
+                           " of a bucket",
+            "auth-ttl": "Seconds a client (and its authorization) is kept",
         })
         return config_help
 
@@ -37,24 +61,65 @@ class BackblazeCollector(diamond.collector.Collector):
         """
         config = super(BackblazeCollector, self).get_default_config()
         config.update({
-            'path': 'backblaze'
+            'path': 'backblaze',
+            'refresh-ttl': 600,
+            'auth-ttl': 3600,
         })
         return config
 
+    def get_client(self):
+        if self.backblaze is None or \
+                self.authorized_at + self.auth_ttl < time.time():
+            self.backblaze = Backblaze(self.account_id, self.application_key)
+            self.authorized_at = time.time()
+        return self.backblaze
+
+    def refresh(self):
+        """Fetch the statistics of every bucket, keeping the previous ones
+        of the buckets failing"""
+        for bucket_name in self.buckets:
+            try:
+                size, number = self.get_client().get_backblaze_infos(
+                    bucket_name)
+            except BackblazeException as e:
+                self.log.error(e)
+                # The authorization may have expired
+                self.backblaze = None
+                continue
+            with self.lock:
+                self.infos[bucket_name] = (size, number, time.time())
+
+    def run_refresher(self):
+        while True:
+            start = time.time()
+            try:
+                self.refresh()
+            except Exception:
+                self.log.exception("Failed to refresh Backblaze statistics")
+            time.sleep(max(1, self.refresh_ttl - (time.time() - start)))
+
     def collect(self):
         """
         Overrides the Collector.collect method
         """
-        backblaze = Backblaze(self.account_id, self.application_key)
-        # Set Metric Name
-        metric_backblaze_size = "%s.%s.space" % (self.account_id,
-                                                 self.bucket_name)
-        metric_backblaze_number = '%s.%s.number' % (self.account_id,
-                                                    self.bucket_name)
-        # Set Metric Value
-        try:
-            size, number = backblaze.get_backblaze_infos(self.bucket_name)
-            self.publish(metric_backblaze_size, size)
-            self.publish(metric_backblaze_number, number)
-        except BackblazeException as e:
-            self.log.error(e)
+        # Started here so that the thread runs in the collector process
+        if self.refresher is None or not self.refresher.is_alive():
+            self.refresher = threading.Thread(target=self.run_refresher,
+                                              name='backblaze-refresher')
+            self.refresher.daemon = True
+            self.refresher.start()
+
+        with self.lock:
+            infos = dict(self.infos)
+        now = time.time()
+        for bucket_name in self.buckets:
+            if bucket_name not in infos:
+                self.log.debug("No statistics of %s yet", bucket_name)
+                continue
+            size, number, fetched_at = infos[bucket_name]
+            # Set Metric Name
+            prefix = "%s.%s." % (self.account_id, bucket_name)
+            # Set Metric Value
+            self.publish(prefix + 'space', size)
+            self.publish(prefix + 'number', number)
+            self.publish(prefix + 'age', int(now - fetched_at))
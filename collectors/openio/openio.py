@@ -11,32 +11,257 @@ Targeted SDS Version: B2 support (unstable)
  * ast
  * json
 
+#### Notes
+
+Stats of the services are fetched concurrently by a pool of `threads`
+workers, from an endpoint depending on the type of the service:
+
+ * rawx: `GET <addr>/stat`
+ * meta0, meta1, meta2, sqlx: `POST <proxy>/v3.0/forward/stats?id=<addr>`
+ * oioproxy: `GET <addr>/v3.0/status`
+ * rdir, account: `GET <addr>/status` (JSON)
+
+Only the types listed in `stats-types` are collected, and `stats-concurrency`
+limits how many services of a type are requested at once (for example
+`meta1:2, rdir:2`). Each service request, body included, is bounded by
+`service-timeout` seconds, and the stats of all the services by the interval
+of the collector. The results are published in a stable order.
+
+A single HTTP connection pool lives as long as the collector, so connections
+to the proxy and to the services are kept alive from one cycle to the next.
+Its usage is published under `collector.sds.http`.
+
+The collector also publishes, under `collector.sds.time`, the time spent in
+each phase of a cycle: discovery, diskspace, fetch (in total and per
+service, summed over the workers), parse and publish, as well as the number
+of errors and timeouts. Set `profile-trigger` to a path in a directory only
+the user running Diamond can write into, and create that file to dump a
+cProfile of the next cycle in `profile-dir` (/var/lib/diamond/openio/profiles
+by default).
+
+Disk space metrics are collected once per device and cycle, for the volume
+(`tag.vol`) of the local services of any type, and published under
+`<namespace>.volume.<filesystem>`. Each service publishes
+`<service>.volume.<filesystem>` (always 1) to map it to its device. The
+former metrics of each rawx (`<service>.<filesystem>.byte_*` and
+`<service>.inodes_*`) are still published, unless `diskspace-per-service` is
+disabled.
+
+The filesystem UUID of each volume is read from an index of
+/proc/self/mountinfo and /dev/disk/by-uuid, rebuilt only when the mount table
+changes. `df` and `blkid` are only run when the index cannot tell.
+
+Each cycle only runs the groups of work which are due according to their
+`intervals` (in seconds, for example `discovery:300, diskspace:60`), the
+others are run in every cycle:
+
+ * discovery: service types listed by the conscience
+ * scores: services listed by the conscience, and their scores
+ * stats: stats of the services
+ * diskspace: disk space of the volumes of the services
+
+Intervals should be multiples of the interval of the collector. Namespace
+configurations are cached for `namespace-conf-ttl` seconds. When the proxy
+cannot be reached, the last known lists of services are used. The lists
+fetched may also be written to `discovery-cache`, where the redis,
+beanstalkd and zookeeper collectors look for their instances. That directory
+(usually /var/lib/diamond/openio) must only be writable by the user running
+Diamond, it is created with mode 0700 when missing.
+
+By default, only the local services (listening on the IP address of the
+proxy) are collected, so Diamond must run on every node. With `shard-hosts`
+set to a list of collector hosts, the services of the whole namespace are
+shared among those hosts by consistent hashing of their address, and each
+host collects the scores and stats of its share. `shard-self` names the
+current host in that list (defaults to the Diamond hostname). Disk space is
+still only collected for local services.
+
+The proxy and each service are called through a circuit breaker: after
+`breaker-threshold` consecutive failures, they are skipped for
+`breaker-backoff` seconds, twice as long after each failed retry. Their
+state is published under `collector.sds.breaker`.
+
+Stats bodies are parsed while they are read, `stats-chunk-size` bytes at a
+time.
+
+Counters of the services are published as they are (`counters = raw`), as
+per second rates suffixed with `_rate` (`counters = rate`), or both. Rates
+are computed from the previous sample of each counter, skipping the samples
+following a reset of the counter (e.g. a restart of the service). With
+`suppress-unchanged`, gauges which did not change are only published again
+after `suppress-max-age` seconds. Series without any sample for `series-ttl`
+seconds are forgotten.
+
 """
 
 import diamond.collector
 import diamond.convertor
 import urllib3
 import json
+import numbers
 import os
+import socket
+import threading
+import time
+from functools import partial
 from subprocess import Popen, PIPE
 
+from openioutils import ConscienceCache, FanOut, HashRing, Scheduler, \
+    SelfMonitor, SeriesStore, SharedCache, VolumeIndex, Watchdog, \
+    conscience_key, iter_stat_lines, monitored, parse_number
+
 try:
     from oio.common.utils import load_namespace_conf
 except:
     from oio.common.configuration import load_namespace_conf
 
 
-class OpenIOSDSCollector(diamond.collector.Collector):
+class ServiceTimeout(Exception):
+    """The stats of a service were not read within service-timeout"""
+
+
+class OpenIOSDSCollector(SelfMonitor, diamond.collector.Collector):
+
+    SELF_PREFIX = 'collector.sds'
+    GROUPS = ('discovery', 'scores', 'stats', 'diskspace')
+
+    # Service type -> method fetching its stats, see get_stats()
+    STATS_FETCHERS = {
+        'rawx': 'get_rawx_stats',
+        'meta0': 'get_gridd_stats',
+        'meta1': 'get_gridd_stats',
+        'meta2': 'get_gridd_stats',
+        'sqlx': 'get_gridd_stats',
+        'oioproxy': 'get_proxy_stats',
+        'rdir': 'get_status_stats',
+        'account': 'get_status_stats',
+    }
 
     def process_config(self):
         super(OpenIOSDSCollector, self).process_config()
         self.namespaces = self.config['namespaces'] or 'OPENIO'
         self.fs = self.config['fs-types'] or ('xfs', 'ext4')
+        self.service_timeout = float(self.config['service-timeout'])
+        self.timeout = urllib3.Timeout(
+            connect=float(self.config['connect-timeout']),
+            read=float(self.config['read-timeout']))
+        self.stats_timeout = urllib3.Timeout(
+            connect=float(self.config['connect-timeout']),
+            read=float(self.config['read-timeout']),
+            total=self.service_timeout)
+        self.stats_chunk_size = int(self.config['stats-chunk-size'])
+        self.fanout = FanOut(self.config['threads'], log=self.log,
+                             monitor=self)
+        self.watchdog = Watchdog()
+        stats_types = self.config['stats-types'] or []
+        if isinstance(stats_types, basestring):
+            stats_types = [stats_types]
+        self.stats_types = set(t.strip() for t in stats_types)
+        concurrency = self.config['stats-concurrency'] or []
+        if isinstance(concurrency, basestring):
+            concurrency = [concurrency]
+        self.stats_limits = {}
+        for limit in concurrency:
+            srvtype, width = limit.strip().rsplit(':', 1)
+            self.stats_limits[srvtype] = threading.BoundedSemaphore(
+                int(width))
+        self.http = None
+        self.volumes = VolumeIndex()
+        self.diskspace_per_service = diamond.collector.str_to_bool(
+            self.config['diskspace-per-service'])
+        # device -> (filesystem, statvfs, namespaces), reset every cycle
+        self.devices = {}
+        self.counters_mode = self.config['counters']
+        if self.counters_mode not in ('raw', 'rate', 'both'):
+            self.log.error("Invalid counters mode %s, using raw",
+                           self.counters_mode)
+            self.counters_mode = 'raw'
+        self.suppress_unchanged = diamond.collector.str_to_bool(
+            self.config['suppress-unchanged'])
+        self.suppress_max_age = float(self.config['suppress-max-age'])
+        self.series_ttl = float(self.config['series-ttl'])
+        self.counters = SeriesStore()
+        self.gauges = SeriesStore()
+        intervals = self.config['intervals'] or []
+        if isinstance(intervals, basestring):
+            intervals = [intervals]
+        intervals = dict((group.strip(), float(interval)) for group, interval
+                         in (i.rsplit(':', 1) for i in intervals))
+        self.scheduler = Scheduler(self.GROUPS, intervals,
+                                   self.config['interval'])
+        self.due = set(self.GROUPS)
+        shard_hosts = self.config['shard-hosts'] or []
+        if isinstance(shard_hosts, basestring):
+            shard_hosts = [shard_hosts]
+        shard_hosts = [h.strip() for h in shard_hosts if h.strip()]
+        self.ring = None
+        if shard_hosts:
+            self.ring = HashRing(shard_hosts, self.config['shard-replicas'])
+            self.shard_self = self.config['shard-self'] or self.get_hostname()
+            if self.shard_self not in shard_hosts:
+                self.log.error("%s is not one of the shard hosts %s, it will"
+                               " only collect local disk space",
+                               self.shard_self, shard_hosts)
+        # Lists are refreshed when due, see get_stats()
+        self.conscience = ConscienceCache(float('inf'),
+                                          self.config['namespace-conf-ttl'],
+                                          log=self.log)
+        self.shared = None
+        if self.config['discovery-cache']:
+            self.shared = SharedCache(self.config['discovery-cache'], 0,
+                                      log=self.log)
 
     def get_default_config_help(self):
         config_help = super(OpenIOSDSCollector, self).get_default_config_help()
         config_help.update({
             'namespaces': "List of namespaces (comma separated)",
+            'threads': "Number of services whose stats are fetched"
+                       " concurrently",
+            'service-timeout': "Deadline (in seconds) of the stats request"
+                               " sent to each service",
+            'connect-timeout': "Timeout (in seconds) to establish a"
+                               " connection",
+            'read-timeout': "Timeout (in seconds) between two reads on a"
+                            " connection",
+            'pool-hosts': "Number of hosts (proxy and services) whose"
+                          " connections are kept alive",
+            'pool-size': "Number of connections kept alive per host,"
+                         " defaults to the number of threads",
+            'shard-hosts': "Collector hosts sharing the services of the"
+                           " namespaces (comma separated), empty to only"
+                           " collect local services",
+            'shard-self': "Name of this host in shard-hosts, defaults to"
+                          " the Diamond hostname",
+            'shard-replicas': "Number of points of each host on the hash"
+                              " ring",
+            'intervals': "Interval (in seconds) of the groups of work not"
+                         " run in every cycle, as group:interval (comma"
+                         " separated), groups are discovery, scores,"
+                         " stats and diskspace",
+            'namespace-conf-ttl': "How long (in seconds) the namespace"
+                                  " configurations are cached",
+            'discovery-cache': "Directory where the lists of services are"
+                               " shared with the other collectors, private"
+                               " to the user running Diamond (empty to"
+                               " disable)",
+            'stats-chunk-size': "Size of the chunks the stats of the"
+                                " services are read by",
+            'stats-types': "Service types whose stats are collected"
+                           " (comma separated)",
+            'stats-concurrency': "Maximum number of services of a type"
+                                 " requested at once, as type:number"
+                                 " (comma separated)",
+            'counters': "Publish the counters of the services as they are"
+                        " (raw), as per second rates (rate) or both",
+            'suppress-unchanged': "Do not publish the gauges of the"
+                                  " services which did not change",
+            'suppress-max-age': "Publish unchanged gauges anyway after this"
+                                " number of seconds",
+            'series-ttl': "Forget the previous sample of a series after"
+                          " this number of seconds",
+            'diskspace-per-service': "Also publish the disk space metrics"
+                                     " under each rawx, as before they"
+                                     " were published per device",
         })
         return config_help
 
@@ -47,10 +272,32 @@ class OpenIOSDSCollector(diamond.collector.Collector):
         config = super(OpenIOSDSCollector, self).get_default_config()
         config.update({
             'path': 'openio',
-            'byte_unit': ['byte']
+            'byte_unit': ['byte'],
+            'threads': 8,
+            'service-timeout': 5.0,
+            'connect-timeout': 1.0,
+            'read-timeout': 5.0,
+            'pool-hosts': 256,
+            'pool-size': None,
+            'intervals': ['discovery:300', 'diskspace:60'],
+            'shard-hosts': [],
+            'shard-self': None,
+            'shard-replicas': 100,
+            'namespace-conf-ttl': 300,
+            'discovery-cache': '',
+            'stats-chunk-size': 65536,
+            'stats-types': ['rawx', 'meta0', 'meta1', 'meta2', 'sqlx',
+                            'rdir', 'account', 'oioproxy'],
+            'stats-concurrency': [],
+            'counters': 'raw',
+            'suppress-unchanged': False,
+            'suppress-max-age': 600,
+            'series-ttl': 3600,
+            'diskspace-per-service': True,
         })
         return config
 
+    @monitored
     def collect(self):
         namespaces = self.namespaces
 
@@ -58,69 +305,190 @@ class OpenIOSDSCollector(diamond.collector.Collector):
         if isinstance(namespaces, basestring):
             namespaces = [namespaces]
 
-        http = urllib3.PoolManager()
+        http = self.get_http()
+        self.due = self.scheduler.due()
+        if 'diskspace' in self.due:
+            self.volumes.refresh()
+        self.devices = {}
         for ns in namespaces:
-            config = load_namespace_conf(ns)
+            with self.phase('discovery'):
+                config = self.conscience.namespace_conf(
+                    ns, load_namespace_conf)
             if not config:
                 self.log.error('No configuration found for namespace ' + ns)
                 continue
             proxy = config['proxy']
             self.get_stats(http, ns, proxy)
+        self.publish_http_stats(http)
+
+    def get_http(self):
+        """Return the connection pool shared by all the collect cycles,
+        built on first use so that it belongs to the collecting process.
+        """
+        if self.http is None:
+            self.http = urllib3.PoolManager(
+                num_pools=int(self.config['pool-hosts']),
+                maxsize=int(self.config['pool-size'] or
+                            self.config['threads']),
+                block=True,
+                timeout=self.timeout)
+        return self.http
+
+    def publish_http_stats(self, http):
+        """Publish how many requests reused a kept-alive connection"""
+        requests = connections = 0
+        pools = list(http.pools.keys())
+        for key in pools:
+            pool = http.pools.get(key)
+            if pool is None:
+                continue
+            requests += pool.num_requests
+            connections += pool.num_connections
+        self.batch(self.SELF_PREFIX + '.http.pools', len(pools))
+        self.batch(self.SELF_PREFIX + '.http.requests', requests,
+                   metric_type='COUNTER')
+        self.batch(self.SELF_PREFIX + '.http.connections_new', connections,
+                   metric_type='COUNTER')
+        self.batch(self.SELF_PREFIX + '.http.connections_reused',
+                   max(0, requests - connections), metric_type='COUNTER')
+
+    def request_json(self, http, url):
+        return json.loads(http.request('GET', url).data)
 
     def get_stats(self, http, namespace, proxy):
-        try:
-            srvtypes = json.loads(http.request(
-                'GET',
-                "%s/v3.0/%s/conscience/info?what=types" % (proxy, namespace)
-                ).data)
-        except Exception as exc:
-            self.log.error("Unable to connect to proxy at %s: %s", proxy, exc)
+        with self.phase('discovery'):
+            srvtypes = self.conscience.service_types(
+                namespace, partial(self.guarded, proxy, self.request_json,
+                                   http,
+                                   "%s/v3.0/%s/conscience/info?what=types" %
+                                   (proxy, namespace)),
+                max_age=0 if 'discovery' in self.due else None)
+        if srvtypes is None:
+            self.log.error("Unable to connect to proxy at %s", proxy)
+            self.count('errors')
             return
+        # assume that all local services are listening
+        # on the same IP address as the proxy
+        proxy_ip = proxy.split('//', 1)[-1].split(":", 1)[0] + ":"
+        refresh = 'discovery' in self.due or 'scores' in self.due
+        jobs_by_type = []
         for srvtype in srvtypes:
-            try:
-                services = http.request('GET',
-                                        "%s/v3.0/%s/conscience/list?type=%s" %
-                                        (proxy, namespace, srvtype))
-            except Exception as exc:
-                self.log.error("Unable to connect to proxy at %s: %s",
-                               proxy, exc)
+            fetch = partial(self.guarded, proxy, self.request_json, http,
+                            "%s/v3.0/%s/conscience/list?type=%s" %
+                            (proxy, namespace, srvtype))
+            if self.shared is not None:
+                fetch = partial(self.shared.through,
+                                conscience_key(namespace, srvtype), fetch)
+            with self.phase('discovery'):
+                services = self.conscience.services(
+                    namespace, srvtype, fetch,
+                    max_age=0 if refresh else None)
+            if services is None:
+                continue
+            fetcher = None
+            if 'stats' in self.due and srvtype in self.stats_types and \
+                    srvtype in self.STATS_FETCHERS:
+                fetcher = getattr(self, self.STATS_FETCHERS[srvtype])
+            jobs = []
+            for s in services.values():
+                local = s.addr.startswith(proxy_ip)
+                if self.ring is None:
+                    mine = local
+                else:
+                    mine = self.ring.get(s.addr) == self.shard_self
+                if not mine and not local:
+                    continue
+                if refresh and mine:
+                    metric_value = self.cast_str(s.score)
+                    if not isinstance(metric_value, basestring):
+                        name, path = self.service_names(s)['score']
+                        self.batch(name, metric_value, path=path)
+                volume = s.tags.get('tag.vol')
+                if local and 'diskspace' in self.due and \
+                        (volume or srvtype == 'rawx'):
+                    with self.phase('diskspace'):
+                        self.get_service_diskspace(namespace, s,
+                                                   volume or '/')
+                if mine and fetcher is not None and self.allow(s.addr):
+                    jobs.append((s.addr, self.fetch_limited,
+                                 (fetcher, http, proxy, s)))
+            jobs_by_type.append(jobs)
+        # Interleave the types, so that the services of a type whose
+        # concurrency is limited do not hold all the workers
+        jobs = []
+        for i in range(max([len(j) for j in jobs_by_type] or [0])):
+            jobs.extend(j[i] for j in jobs_by_type if i < len(j))
+        # Services are bounded by service-timeout, and the cycle by the
+        # interval even if they queue up behind stats-concurrency
+        for _addr, result in self.fanout.run(
+                jobs, timeout=float(self.config['interval'])):
+            if result is None:
+                continue
+            sampled, metrics = result
+            for metric_name, metric_value, metric_type, metric_path in \
+                    metrics or ():
+                self.publish_series(metric_name, metric_value, metric_type,
+                                    sampled, metric_path)
+        before = time.time() - self.series_ttl
+        self.counters.expire(before)
+        self.gauges.expire(before)
+
+    def service_names(self, service):
+        """Return the MetricNames of a service"""
+        if service.names is None:
+            service.names = self.metric_names(service.prefix + '.')
+        return service.names
+
+    def publish_series(self, name, value, metric_type, now, path=None):
+        """Publish a stat of a service, as configured by `counters` and
+        `suppress-unchanged`"""
+        if metric_type == 'COUNTER':
+            if self.counters_mode != 'rate':
+                self.batch(name, value, metric_type=metric_type, path=path)
+            if self.counters_mode != 'raw':
+                rate = self.counters.rate(name, value, now)
+                if rate is not None:
+                    self.batch(name + '_rate', rate, precision=3)
+            return
+        if self.suppress_unchanged:
+            last = self.gauges.get(name)
+            if last is not None and last[0] == value and \
+                    now - last[1] < self.suppress_max_age:
                 return
-            services = json.loads(services.data)
-            # assume that all local services are listening
-            # on the same IP address as the proxy
-            proxy_ip = proxy.split('//', 1)[-1].split(":", 1)[0] + ":"
-            for s in (x for x in services
-                      if x.get('addr', "").startswith(proxy_ip)):
-                metric_prefix = "%s.%s.%s" % (namespace,
-                                              srvtype,
-                                              s['addr'].replace('.', '_'))
-                metric_value = self.cast_str(s['score'])
-                if not isinstance(metric_value, basestring):
-                    self.publish(metric_prefix + ".score", metric_value)
-                if srvtype == 'rawx':
-                    self.get_service_diskspace(
-                        metric_prefix, s.get("tags", {}).get('tag.vol', '/'))
-                    self.get_rawx_stats(http, s['addr'], namespace)
-                elif srvtype == 'meta2':
-                    self.get_gridd_stats(http, proxy, s['addr'],
-                                         namespace, srvtype)
+            self.gauges.set(name, value, now)
+        self.batch(name, value, metric_type=metric_type, path=path)
 
     def get_filesystem(self, volume):
-        """ Fetches the block id of a provided volume to include
-        as an additional tag
+        """ Fetches the UUID (or the device when it has none) of the
+        filesystem holding a provided volume to include as an additional tag
         """
+        found = self.volumes.lookup(volume)
+        if found is not None:
+            device, uuid = found
+            if uuid or not device.startswith('/dev/'):
+                return uuid or device
+        filesystem = self.volumes.recall(volume)
+        if filesystem is None:
+            filesystem = self.get_filesystem_from_commands(volume)
+            if filesystem is not None:
+                self.volumes.remember(volume, filesystem)
+        return filesystem
+
+    def get_filesystem_from_commands(self, volume):
+        """ Fallback of get_filesystem() asking df and blkid """
         try:
             p = Popen(['df', volume], stdout=PIPE,
-                      stderr=PIPE)
+                      stderr=PIPE, universal_newlines=True)
             stdout, stderr = p.communicate()
             if stderr:
                 self.log.exception(stderr)
             device = stdout.split('\n')[1].split()[0]
             try:
-                p = Popen(['blkid', device], stdout=PIPE, stderr=PIPE)
+                p = Popen(['blkid', '-s', 'UUID', '-o', 'value', device],
+                          stdout=PIPE, stderr=PIPE, universal_newlines=True)
                 stdout, stderr = p.communicate()
-                uuid = stdout.split("UUID=")[1].split(' ')[0][:-1]
-                return str(uuid)
+                uuid = stdout.strip()
+                return str(uuid or device)
             except Exception as e:
                 self.log.exception(e)
                 return str(device)
@@ -128,107 +496,255 @@ class OpenIOSDSCollector(diamond.collector.Collector):
             self.log.exception(e)
             return
 
-    def get_service_diskspace(self, metric_prefix, volume):
-        if hasattr(os, 'statvfs'):  # POSIX
-            try:
-                data = os.statvfs(volume)
-            except OSError as e:
-                self.log.exception(e)
-                return
-            block_size = data.f_bsize
-            blocks_total = data.f_blocks
-            blocks_free = data.f_bfree
-            blocks_avail = data.f_bavail
-            inodes_total = data.f_files
-            inodes_free = data.f_ffree
-            inodes_avail = data.f_favail
-        else:
+    def get_device(self, volume):
+        """Return the name and the statvfs of the filesystem holding a
+        volume, computed once per device and cycle, and the namespaces it has
+        already been published for.
+        """
+        if not hasattr(os, 'statvfs'):  # POSIX
             raise NotImplementedError("platform not supported")
+        try:
+            device = os.stat(volume).st_dev
+            found = self.devices.get(device)
+            if found is None:
+                data = os.statvfs(volume)
+                dvolume = self.get_filesystem(volume) or volume
+                dvolume = dvolume.replace("/", "-").lstrip('-')
+                dvolume = dvolume.replace('_', '-')
+                found = self.devices[device] = (dvolume, data, set())
+        except OSError as e:
+            self.log.exception(e)
+            return
+        return found
+
+    def get_service_diskspace(self, namespace, service, volume):
+        found = self.get_device(volume)
+        if found is None:
+            return
+        dvolume, data, namespaces = found
+        self.batch('%s.volume.%s' % (service.prefix, dvolume), 1)
+        if self.diskspace_per_service and service.srvtype == 'rawx':
+            self.publish_diskspace(
+                '%s.%s' % (service.prefix, dvolume), service.prefix, data)
+        if namespace not in namespaces:
+            namespaces.add(namespace)
+            metric_prefix = '%s.volume.%s' % (namespace, dvolume)
+            self.publish_diskspace(metric_prefix, metric_prefix, data)
 
-        dvolume = self.get_filesystem(volume).replace("/", "-")[1:]
-        dvolume = dvolume.replace('_', '-')
+    def publish_diskspace(self, bytes_prefix, metric_prefix, data):
+        block_size = data.f_bsize
+        blocks_total = data.f_blocks
+        blocks_free = data.f_bfree
+        blocks_avail = data.f_bavail
+        inodes_total = data.f_files
+        inodes_free = data.f_ffree
+        inodes_avail = data.f_favail
 
         for unit in self.config['byte_unit']:
-            metric_name = '%s.%s.%s_percentfree'\
-                            % (metric_prefix, dvolume, unit)
+            metric_name = '%s.%s_percentfree' % (bytes_prefix, unit)
             metric_value = float(blocks_free) / float(
                 blocks_free + (blocks_total - blocks_free)) * 100
-            self.publish_gauge(metric_name, metric_value, 2)
+            self.batch(metric_name, metric_value, 2)
 
-            metric_name = '%s.%s.%s_used' % (metric_prefix, dvolume, unit)
+            metric_name = '%s.%s_used' % (bytes_prefix, unit)
             metric_value = float(block_size) * float(
                 blocks_total - blocks_free)
             metric_value = diamond.convertor.binary.convert(
                 value=metric_value, oldUnit='byte', newUnit=unit)
-            self.publish_gauge(metric_name, metric_value, 2)
+            self.batch(metric_name, metric_value, 2)
 
-            metric_name = '%s.%s.%s_free' % (metric_prefix, dvolume, unit)
+            metric_name = '%s.%s_free' % (bytes_prefix, unit)
             metric_value = float(block_size) * float(blocks_free)
             metric_value = diamond.convertor.binary.convert(
                 value=metric_value, oldUnit='byte', newUnit=unit)
-            self.publish_gauge(metric_name, metric_value, 2)
+            self.batch(metric_name, metric_value, 2)
 
-            metric_name = '%s.%s.%s_avail' % (metric_prefix, dvolume, unit)
+            metric_name = '%s.%s_avail' % (bytes_prefix, unit)
             metric_value = float(block_size) * float(blocks_avail)
             metric_value = diamond.convertor.binary.convert(
                 value=metric_value, oldUnit='byte', newUnit=unit)
-            self.publish_gauge(metric_name, metric_value, 2)
+            self.batch(metric_name, metric_value, 2)
 
         if float(inodes_total) > 0:
-            self.publish_gauge(
+            self.batch(
                 '%s.inodes_percentfree' % metric_prefix,
                 float(inodes_free) / float(inodes_total) * 100)
-        self.publish_gauge('%s.inodes_used' % metric_prefix,
-                           inodes_total - inodes_free)
-        self.publish_gauge('%s.inodes_free' % metric_prefix, inodes_free)
-        self.publish_gauge('%s.inodes_avail' % metric_prefix, inodes_avail)
+        self.batch('%s.inodes_used' % metric_prefix,
+                   inodes_total - inodes_free)
+        self.batch('%s.inodes_free' % metric_prefix, inodes_free)
+        self.batch('%s.inodes_avail' % metric_prefix, inodes_avail)
+
+    def fetch_limited(self, fetcher, http, proxy, service):
+        """Call a stats fetcher within the concurrency limit of the type
+        of the service, runs in a worker thread
+
+        :returns: the time of the sample and the metrics of the service
+        """
+        limit = self.stats_limits.get(service.srvtype)
+        if limit is None:
+            start = time.time()
+            metrics = fetcher(http, proxy, service)
+        else:
+            with limit:
+                start = time.time()
+                metrics = fetcher(http, proxy, service)
+        now = time.time()
+        self.add_time('fetch', now - start)
+        self.add_time('fetch.' + service.prefix, now - start)
+        if metrics is None:
+            self.breakers.failure(service.addr)
+        else:
+            self.breakers.success(service.addr)
+        return now, metrics
+
+    def get_rawx_stats(self, http, proxy, service):
+        """Fetch the stats of a rawx service, runs in a worker thread
+
+        :rtype: list of (metric_name, metric_value, metric_type,
+            metric_path) tuples
+        """
+        return self.fetch_stats(http, 'GET', service.addr + '/stat', service)
+
+    def get_gridd_stats(self, http, proxy, service):
+        """Fetch the stats of a gridd service through the proxy, runs in a
+        worker thread
+
+        :rtype: list of (metric_name, metric_value, metric_type,
+            metric_path) tuples
+        """
+        return self.fetch_stats(
+            http, 'POST', proxy + '/v3.0/forward/stats?id=' + service.addr,
+            service)
+
+    def get_proxy_stats(self, http, proxy, service):
+        """Fetch the stats of an oioproxy service, runs in a worker thread
+
+        :rtype: list of (metric_name, metric_value, metric_type,
+            metric_path) tuples
+        """
+        return self.fetch_stats(
+            http, 'GET', service.addr + '/v3.0/status', service)
+
+    def get_status_stats(self, http, proxy, service):
+        """Fetch the JSON status of a python service (rdir, account), runs
+        in a worker thread
 
-    def get_rawx_stats(self, http, addr, namespace, srv_type='rawx'):
+        :rtype: list of (metric_name, metric_value, metric_type,
+            metric_path) tuples
+        """
+        deadline = time.time() + self.service_timeout
+        url = service.addr + '/status'
         stat = None
         try:
-            stat = http.request('GET', addr+'/stat')
+            stat = http.request('GET', url, timeout=self.stats_timeout,
+                                preload_content=False)
+            status = json.loads(b''.join(self.iter_body(stat, url, deadline)))
+        except ServiceTimeout:
+            self.body_timeout(stat, url)
+            return
         except Exception as e:
             self.log.exception(e)
+            self.count('errors')
             return
-        for m in (stat.data).split('\n'):
-            if not m:
-                continue
-            metric_type, metric_name, metric_value = m.split(' ')
-            metric_value = self.cast_str(metric_value)
-            if not isinstance(metric_value, basestring):
-                metric_name = "%s.%s.%s.%s" % (namespace,
-                                               srv_type,
-                                               addr.replace('.', '_'),
-                                               metric_name)
-                self.publish(metric_name, metric_value,
-                             metric_type=metric_type.upper())
-
-    def get_gridd_stats(self, http, proxy, addr, namespace, srv_type):
+        finally:
+            if stat is not None:
+                stat.release_conn()
+        metrics = []
+        if not isinstance(status, dict):
+            return metrics
+        names = self.service_names(service)
+        pending = [('', status)]
+        while pending:
+            prefix, values = pending.pop()
+            for key in sorted(values):
+                value = values[key]
+                if isinstance(value, dict):
+                    pending.append(('%s%s.' % (prefix, key), value))
+                elif isinstance(value, numbers.Number) and \
+                        not isinstance(value, bool):
+                    name, path = names[prefix + key]
+                    metrics.append((name, value, 'GAUGE', path))
+        self.count_names(names, len(metrics))
+        return metrics
+
+    def fetch_stats(self, http, method, url, service):
+        deadline = time.time() + self.service_timeout
         stat = None
         try:
-            stat = http.request('POST', proxy+'/v3.0/forward/stats?id='+addr)
+            stat = http.request(method, url, timeout=self.stats_timeout,
+                                preload_content=False)
         except Exception as e:
             self.log.exception(e)
+            self.count('errors')
             return
-        for m in (stat.data).split('\n'):
-            if not m:
-                continue
-            metric_type, metric_name, metric_value = m.split(' ')
-            metric_value = self.cast_str(metric_value)
-            if not isinstance(metric_value, basestring):
-                metric_name = "%s.%s.%s.%s" % (namespace,
-                                               srv_type,
-                                               addr.replace('.', '_'),
-                                               metric_name)
-                self.publish(metric_name, metric_value,
-                             metric_type=metric_type.upper())
+        # Time spent waiting for the chunks, the remainder being parsing
+        waited = [0.0]
+        start = time.time()
+        names = self.service_names(service)
+        try:
+            metrics = list(iter_stat_lines(
+                self.iter_body(stat, url, deadline, waited),
+                service.prefix + '.', names))
+            self.count_names(names, len(metrics))
+            return metrics
+        except ServiceTimeout:
+            self.body_timeout(stat, url)
+            return
+        except Exception as e:
+            self.log.exception(e)
+            self.count('errors')
+            return
+        finally:
+            self.add_time('parse', time.time() - start - waited[0])
+            stat.release_conn()
 
-    def cast_str(self, value):
-        """Return string casted to int or float if possible"""
+    def iter_body(self, stat, url, deadline, waited=None):
+        """Yield the chunks of a response body until `deadline`, which the
+        total timeout of urllib3 does not cover, adding the time spent
+        waiting for them to waited[0]"""
+        # A read only returns once its chunk is full, however slowly the
+        # service sends it: the connection is shut down at the deadline
+        alarm = self.watchdog.arm(deadline, self.shutdown_response, stat)
         try:
-            return int(value)
-        except ValueError:
+            stream = stat.stream(self.stats_chunk_size)
+            while True:
+                start = time.time()
+                try:
+                    chunk = next(stream, None)
+                except Exception:
+                    if time.time() > deadline:
+                        # shut down by the watchdog
+                        raise ServiceTimeout(url)
+                    raise
+                if waited is not None:
+                    waited[0] += time.time() - start
+                if time.time() > deadline:
+                    raise ServiceTimeout(url)
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            self.watchdog.cancel(alarm)
+
+    def shutdown_response(self, stat):
+        # The socket the body is read from: the file of httplib wraps it in
+        # a socket._fileobject on Python 2, in a SocketIO on Python 3
+        fp = getattr(getattr(stat, '_fp', None), 'fp', None)
+        sock = getattr(getattr(fp, 'raw', fp), '_sock', None)
+        if sock is not None:
             try:
-                return float(value)
-            except ValueError:
-                return value
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def body_timeout(self, stat, url):
+        self.log.error("Response of %s not read after %ss", url,
+                       self.service_timeout)
+        self.count('timeouts')
+        # Do not keep a connection whose body has not been read
+        stat.close()
+
+    def cast_str(self, value):
+        """Return string casted to int or float if possible"""
+        number = parse_number(str(value))
+        return value if number is None else number
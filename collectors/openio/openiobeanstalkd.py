@@ -5,29 +5,180 @@ Collects the following from beanstalkd:
     - Server statistics via the 'stats' command
     - Per tube statistics via the 'stats-tube' command
 
+One connection is kept open to each instance, and the `stats-tube` commands
+of all the tubes are pipelined. The replies are parsed by a minimal built-in
+client, without YAML; `client = beanstalkc` switches back to beanstalkc.
+
+Only the tubes matching one of `tubes-include` and none of `tubes-exclude`
+(shell-style patterns) are published, and with `tubes-top` set, only that
+many of them with the most ready jobs.
+
+With `discovery-namespaces` set, the local services of `discovery-types`
+(beanstalkd by default) registered in the conscience of those namespaces
+are collected too. Up to `threads` instances are queried at once, within
+`deadline` seconds (defaults to the collector interval).
+
+The time spent querying the instances, and the number of errors, are
+published under `collector.beanstalkd`. An instance failing
+`breaker-threshold` times in a row is skipped for a while, see
+`collector.beanstalkd.breaker`, and so is an instance still answering a
+previous cycle, whose connection is in use.
+
 #### Dependencies
 
- * beanstalkc
+ * beanstalkc (only with `client = beanstalkc`)
 
 """
 
+import fnmatch
 import re
+import socket
+import threading
 import diamond.collector
 
+from openioutils import ConscienceDiscovery, FanOut, SelfMonitor, \
+    monitored, parse_number
+
 try:
     import beanstalkc
 except ImportError:
     beanstalkc = None
 
 
-class OpenioBeanstalkdCollector(diamond.collector.Collector):
+class BeanstalkdError(Exception):
+    pass
+
+
+def stat_name(prefix, stat):
+    return prefix + stat.replace('-', '_')
+
+
+def tube_stat_name(prefix, key):
+    tube, stat = key
+    return '%stubes.%s.%s' % (prefix, tube, stat.replace('-', '_'))
+
+
+def parse_stats(body):
+    """Parse the flat `key: value` YAML document of a stats reply, into
+    ints and floats when possible"""
+    stats = {}
+    for line in body.splitlines():
+        key, sep, value = line.partition(': ')
+        if not sep:
+            continue
+        number = None if key == 'name' else parse_number(value)
+        stats[key] = value.strip('"') if number is None else number
+    return stats
+
+
+class BeanstalkdClient(object):
+    """Client of the few read-only commands the collector sends"""
+
+    def __init__(self, host, port, timeout):
+        self._sock = socket.create_connection((host, port), timeout)
+        self._file = self._sock.makefile('rb')
+
+    def close(self):
+        try:
+            self._file.close()
+            self._sock.close()
+        except socket.error:
+            pass
+
+    def _send(self, commands):
+        self._sock.sendall(''.join(commands).encode('utf-8'))
+
+    def _read(self, command):
+        """Return the body of an OK reply, None for NOT_FOUND"""
+        line = self._file.readline()
+        if not line.endswith(b'\r\n'):
+            raise BeanstalkdError('%s: connection closed' % command)
+        status = line.split()
+        if status[0] == b'OK':
+            size = int(status[1])
+            body = self._file.read(size + 2)
+            if len(body) != size + 2:
+                raise BeanstalkdError('%s: connection closed' % command)
+            return body[:-2].decode('utf-8')
+        if status[0] == b'NOT_FOUND':
+            return None
+        raise BeanstalkdError('%s: %s' % (command,
+                                          line.strip().decode('utf-8')))
+
+    def stats(self):
+        self._send(['stats\r\n'])
+        return parse_stats(self._read('stats'))
+
+    def tubes(self):
+        self._send(['list-tubes\r\n'])
+        return [line[2:] for line in self._read('list-tubes').splitlines()
+                if line.startswith('- ')]
+
+    def stats_tubes(self, tubes, depth):
+        """Return the stats of the tubes, sending `depth` requests before
+        reading their replies"""
+        stats = []
+        for start in range(0, len(tubes), depth):
+            batch = tubes[start:start + depth]
+            self._send(['stats-tube %s\r\n' % tube for tube in batch])
+            for _tube in batch:
+                body = self._read('stats-tube')
+                # None when deleted since list-tubes
+                if body is not None:
+                    stats.append(parse_stats(body))
+        return stats
+
+
+class OpenioBeanstalkdCollector(ConscienceDiscovery, SelfMonitor,
+                                diamond.collector.Collector):
+    SELF_PREFIX = 'collector.beanstalkd'
+    DISCOVERY_TYPES = ('beanstalkd',)
     SKIP_LIST = ['version', 'id', 'hostname']
     COUNTERS_REGEX = re.compile(
         r'^(cmd-.*|job-timeouts|total-jobs|total-connections)$')
+    # stats-tube commands sent before reading their replies, low enough
+    # for the replies to fit in the socket buffers
+    PIPELINE_DEPTH = 64
 
     def process_config(self):
         super(OpenioBeanstalkdCollector, self).process_config()
-        self.instances = self.config.get('instances', 'OPENIO:127.0.0.1:6014')
+        instances = self.config.get('instances')
+        if instances is None and not self.discovery_namespaces:
+            instances = 'OPENIO:127.0.0.1:6014'
+        if isinstance(instances, basestring):
+            instances = instances.split(',')
+        self.instances = []
+        for instance in instances or []:
+            if not instance.strip():
+                continue
+            namespace, host, port = instance.strip().split(':')
+            self.instances.append((namespace, host, int(port)))
+
+        self.tubes_include = self._patterns('tubes-include')
+        self.tubes_exclude = self._patterns('tubes-exclude')
+        self.tubes_top = int(self.config['tubes-top'])
+
+        self.native = self.config['client'] != 'beanstalkc'
+        self.errors = (BeanstalkdError, socket.error)
+        if beanstalkc is not None:
+            self.errors += (beanstalkc.BeanstalkcException,)
+
+        # Long-lived connections, and the locks of their fetches, by endpoint
+        self.connections = {}
+        self.busy = {}
+        # Names of the metrics, by instance
+        self.names = {}
+        self.fanout = FanOut(self.config['threads'], log=self.log,
+                             monitor=self)
+        self.deadline = float(self.config['deadline'] or
+                              self.config['interval'])
+
+    def _patterns(self, key):
+        patterns = self.config[key] or []
+        if isinstance(patterns, basestring):
+            patterns = [patterns]
+        return [re.compile(fnmatch.translate(p.strip()))
+                for p in patterns if p.strip()]
 
     def get_default_config_help(self):
         config_help = super(OpenioBeanstalkdCollector,
@@ -35,6 +186,16 @@ class OpenioBeanstalkdCollector(diamond.collector.Collector):
         config_help.update({
             'instances': 'List of instances in the form NAMESPACE:host:port\
                          (comma separated)',
+            'timeout': 'Socket timeout',
+            'threads': 'Number of instances queried at once',
+            'deadline': 'Seconds allowed to query all the instances,\
+                        defaults to the interval',
+            'tubes-include': 'Patterns of the tubes to publish',
+            'tubes-exclude': 'Patterns of the tubes not to publish',
+            'tubes-top': 'Only publish the tubes with the most ready jobs,\
+                         0 to publish all of them',
+            'client': 'native, or beanstalkc to parse the replies with\
+                      beanstalkc and PyYAML',
         })
         return config_help
 
@@ -45,58 +206,174 @@ class OpenioBeanstalkdCollector(diamond.collector.Collector):
         config = super(OpenioBeanstalkdCollector, self).get_default_config()
         config.update({
             'path':     'openio',
+            'timeout': 5,
+            'threads': 4,
+            'deadline': None,
+            'tubes-include': ['*'],
+            'tubes-exclude': [],
+            'tubes-top': 0,
+            'client': 'native',
         })
         return config
 
+    def _connect(self, host, port):
+        if self.native:
+            return BeanstalkdClient(host, port, float(self.config['timeout']))
+        connection = beanstalkc.Connection(
+            host, port, connect_timeout=float(self.config['timeout']))
+        # beanstalkc does not time out once connected
+        connection._socket.settimeout(float(self.config['timeout']))
+        return connection
+
+    def _stats_tubes(self, connection, tubes):
+        """Return the stats of the tubes, pipelining the requests"""
+        try:
+            sock = connection._socket
+            read_response = connection._read_response
+            read_body = connection._read_body
+            parse = connection._parse_yaml
+        except AttributeError:
+            # beanstalkc internals changed, one round trip per tube
+            return [connection.stats_tube(tube) for tube in tubes]
+
+        stats = []
+        for start in range(0, len(tubes), self.PIPELINE_DEPTH):
+            batch = tubes[start:start + self.PIPELINE_DEPTH]
+            try:
+                sock.sendall(''.join('stats-tube %s\r\n' % tube
+                                     for tube in batch))
+            except socket.error as err:
+                raise beanstalkc.SocketError(err)
+            for tube in batch:
+                status, results = read_response()
+                if status == 'NOT_FOUND':
+                    # Deleted since list-tubes
+                    continue
+                if status != 'OK':
+                    raise beanstalkc.UnexpectedResponse('stats-tube', status,
+                                                        results)
+                stats.append(parse(read_body(int(results[0]))))
+        return stats
+
+    def _wanted(self, tube):
+        return any(p.match(tube) for p in self.tubes_include) and \
+            not any(p.match(tube) for p in self.tubes_exclude)
+
     def _get_stats(self, host, port):
         stats = {}
+        endpoint = '%s:%s' % (host, port)
+        connection = self.connections.get(endpoint)
+        if connection is None:
+            try:
+                connection = self._connect(host, port)
+            except self.errors as e:
+                self.log.error("Couldn't connect to beanstalkd: %s", e)
+                self.count('errors')
+                return None
+            self.connections[endpoint] = connection
+
         try:
-            connection = beanstalkc.Connection(host, int(port))
-        except beanstalkc.BeanstalkcException as e:
-            self.log.error("Couldn't connect to beanstalkd: %s", e)
+            stats['instance'] = connection.stats()
+            tubes = [t for t in connection.tubes() if self._wanted(t)]
+            if self.native:
+                stats['tubes'] = connection.stats_tubes(tubes,
+                                                        self.PIPELINE_DEPTH)
+            else:
+                stats['tubes'] = self._stats_tubes(connection, tubes)
+        except self.errors as e:
+            self.log.error("Couldn't get stats from beanstalkd: %s", e)
+            self.count('errors')
+            # Start over with a fresh connection next time
+            del self.connections[endpoint]
+            connection.close()
             return None
 
-        stats['instance'] = connection.stats()
-        stats['tubes'] = []
-
-        for tube in connection.tubes():
-            tube_stats = connection.stats_tube(tube)
-            stats['tubes'].append(tube_stats)
-
+        if self.tubes_top > 0:
+            stats['tubes'].sort(key=lambda s: s['current-jobs-ready'],
+                                reverse=True)
+            del stats['tubes'][self.tubes_top:]
         return stats
 
+    def fetch_instance(self, host, port):
+        """Fetch the stats of an instance, from a worker thread"""
+        endpoint = '%s:%s' % (host, port)
+        # A fetch given up at the deadline may still be using the connection
+        busy = self.busy.setdefault(endpoint, threading.Lock())
+        if not busy.acquire(False):
+            self.log.error("Previous fetch from %s still running, skipped",
+                           endpoint)
+            self.count('skipped')
+            return None
+        try:
+            with self.phase('fetch'):
+                info = self._get_stats(host, port)
+        finally:
+            busy.release()
+        if not info:
+            self.breakers.failure(endpoint)
+            return None
+        self.breakers.success(endpoint)
+        return info
+
+    @monitored
     def collect(self):
-        if beanstalkc is None:
+        if not self.native and beanstalkc is None:
             self.log.error('Unable to import beanstalkc')
             return {}
 
-        instances = self.instances
-        if isinstance(instances, basestring):
-            instances = instances.split(',')
+        instances = list(self.instances)
+        with self.phase('discovery'):
+            known = set(instance[1:] for instance in instances)
+            for instance in self.discover():
+                if instance[1:] not in known:
+                    known.add(instance[1:])
+                    instances.append(instance)
 
-        for instance in instances:
-            namespace, host, port = instance.split(':')
-            info = self._get_stats(host, port)
-            if not info:
+        jobs = [(instance, self.fetch_instance, instance[1:])
+                for instance in instances
+                if self.allow('%s:%s' % instance[1:])]
+        # Forget the names of the instances no longer collected
+        for instance in set(self.names).difference(instances):
+            del self.names[instance]
+        for instance, info in self.fanout.run(jobs, timeout=self.deadline):
+            if info is None:
                 continue
-            metric_prefix = "%s.beanstalkd.%s:%s." % (namespace,
-                                                      host.replace('.', '_'),
-                                                      port)
+            names, tube_names = self.instance_names(instance)
+            lookups = 0
 
             for stat, value in info['instance'].items():
                 if stat not in self.SKIP_LIST:
-                    stat = stat.replace('-', '_')
-                    self.publish("%s%s" % (metric_prefix, stat), value,
-                                 metric_type=self.get_metric_type(stat))
+                    name, path = names[stat]
+                    self.batch(name, value, path=path,
+                               metric_type=self.get_metric_type(
+                                   stat.replace('-', '_')))
+                    lookups += 1
 
             for tube_stats in info['tubes']:
                 tube = tube_stats['name']
                 for stat, value in tube_stats.items():
                     if stat != 'name':
-                        _stat = stat.replace('-', '_')
-                        b_name = '%stubes.%s.%s' % (metric_prefix, tube, _stat)
+                        b_name, path = tube_names[(tube, stat)]
                         metric = self.get_metric_type(stat)
-                        self.publish(b_name, value, metric_type=metric)
+                        self.batch(b_name, value, metric_type=metric,
+                                   path=path)
+                        lookups += 1
+            self.count_names(names, 0)
+            self.count_names(tube_names, lookups)
+
+    def instance_names(self, instance):
+        """Return the MetricNames of the stats and of the tube stats of an
+        instance"""
+        found = self.names.get(instance)
+        if found is None:
+            namespace, host, port = instance
+            metric_prefix = "%s.beanstalkd.%s:%s." % (namespace,
+                                                      host.replace('.', '_'),
+                                                      port)
+            found = self.names[instance] = (
+                self.metric_names(metric_prefix, render=stat_name),
+                self.metric_names(metric_prefix, render=tube_stat_name))
+        return found
 
     def get_metric_type(self, stat):
         if self.COUNTERS_REGEX.match(stat):
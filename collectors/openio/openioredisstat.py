@@ -21,11 +21,46 @@ enabled=True
 instances = namespace1:host1:port1, namespace2:host2:port2/PASSWORD, ...
 ```
 
+Local instances can be reached through their unix socket, with
+`namespace:unix:/path/to/redis.sock`.
+
+With `discovery-namespaces` set, the local services of `discovery-types`
+(redis by default) registered in the conscience of those namespaces are
+collected too, authenticated with `auth`.
+
+One connection is kept open to each instance, and each cycle costs a single
+pipelined round trip: INFO of the published sections, plus
+`CONFIG GET maxmemory` every `maxmemory-ttl` seconds. Up to `threads`
+instances are queried at once, and the instances not done within `deadline`
+seconds (defaults to the collector interval) are counted in
+`collector.redis.timeouts` and left for the next cycle.
+
+With `slowlog` enabled, the SLOWLOG entries logged since the previous cycle
+(at most `slowlog-max-entries` of them) are published as `slowlog.count` and,
+for the `slowlog-top` most frequent commands, the number of slow calls and
+the median, 99th percentile and max durations (in microseconds). With
+`latency` enabled, the latest and max latencies (in milliseconds) of each
+event of `LATENCY LATEST` are published.
+
+For each command of `commands`, the calls per second and the average time
+per call (in microseconds) since the previous cycle are computed from the
+`commandstats` INFO section and published under `commands.<name>`.
+
+The time spent querying the instances, and the number of errors, are
+published under `collector.redis`. An instance failing
+`breaker-threshold` times in a row is skipped for a while, see
+`collector.redis.breaker`.
+
 """
 
 import diamond.collector
+import re
 import time
 
+from diamond.collector import str_to_bool
+from openioutils import ConscienceDiscovery, FanOut, SelfMonitor, \
+    SeriesStore, monitored, percentile
+
 try:
     import redis
 except ImportError:
@@ -36,7 +71,11 @@ SOCKET_PREFIX = 'unix:'
 SOCKET_PREFIX_LEN = len(SOCKET_PREFIX)
 
 
-class OpenioRedisCollector(diamond.collector.Collector):
+class OpenioRedisCollector(ConscienceDiscovery, SelfMonitor,
+                           diamond.collector.Collector):
+
+    SELF_PREFIX = 'collector.redis'
+    DISCOVERY_TYPES = ('redis',)
 
     _DATABASE_COUNT = 16
     _DEFAULT_DB = 0
@@ -70,6 +109,9 @@ class OpenioRedisCollector(diamond.collector.Collector):
              'slaves.last_io': 'master_last_io_seconds_ago'}
     _RENAMED_KEYS = {'last_save.changes_since': 'rdb_changes_since_last_save',
                      'last_save.time': 'rdb_last_save_time'}
+    # INFO sections holding the keys above
+    _SECTIONS = ('server', 'clients', 'memory', 'persistence', 'stats',
+                 'replication', 'cpu', 'keyspace')
 
     def process_config(self):
         super(OpenioRedisCollector, self).process_config()
@@ -80,17 +122,47 @@ class OpenioRedisCollector(diamond.collector.Collector):
 
         self.instances = {}
         for instance in instance_list:
+            if not instance.strip():
+                continue
 
-            (namespace, host, port) = instance.split(':')
+            namespace, address = instance.strip().split(':', 1)
 
-            if '/' in port:
-                port, auth = port.split('/')
+            if address.startswith(SOCKET_PREFIX):
+                # The path is the host, without port
+                host, port = address[SOCKET_PREFIX_LEN:], None
+                auth = self.config['auth']
+                nick = 'unix_' + host.strip('/').replace('/', '_')\
+                    .replace('.', '_')
             else:
-                auth = None
-
-            nick = '%s:%s' % (host.replace('.', '_'), port)
+                host, port = address.split(':')
+                if '/' in port:
+                    port, auth = port.split('/')
+                else:
+                    auth = self.config['auth']
+                port = int(port)
+                nick = '%s:%s' % (host.replace('.', '_'), port)
             self.instances[nick] = (namespace, host, port, auth)
 
+        # Long-lived clients and cached maxmemory, by nick
+        self.clients = {}
+        self.maxmemory = {}
+        # Last slowlog entry seen, by nick
+        self.slowlog_ids = {}
+
+        # INFO commandstats keys of the allowed commands, with the names of
+        # their metrics
+        commands = self.config['commands'] or []
+        if isinstance(commands, basestring):
+            commands = [commands]
+        self.commands = [('cmdstat_' + c.strip().lower(),
+                          'commands.%s.' % c.strip().lower())
+                         for c in commands if c.strip()]
+        self.series = SeriesStore()
+        self.fanout = FanOut(self.config['threads'], log=self.log,
+                             monitor=self)
+        self.deadline = float(self.config['deadline'] or
+                              self.config['interval'])
+
         self.log.debug("Configured instances: %s" % self.instances.items())
 
     def get_default_config_help(self):
@@ -102,7 +174,20 @@ class OpenioRedisCollector(diamond.collector.Collector):
             'auth': 'Password?',
             'databases': 'how many database instances to collect',
             'instances': "Redis addresses, comma separated, syntax:" +
-                         " namespace:host:port"
+                         " namespace:host:port or namespace:unix:/path",
+            'maxmemory-ttl': "Seconds between two reads of the maxmemory" +
+                             " setting",
+            'threads': "Number of instances queried at once",
+            'slowlog': "Publish the commands of the slowlog",
+            'slowlog-max-entries': "Max number of slowlog entries read" +
+                                   " per cycle",
+            'slowlog-top': "Number of commands whose slowlog entries are" +
+                           " published, the others are summed in 'other'",
+            'latency': "Publish the latest latency events",
+            'commands': "Commands whose calls per second and time per" +
+                        " call are published (comma separated)",
+            'deadline': "Seconds allowed to query all the instances," +
+                        " defaults to the interval",
         })
         return config_help
 
@@ -121,28 +206,38 @@ class OpenioRedisCollector(diamond.collector.Collector):
             'databases': self._DATABASE_COUNT,
             'path': 'openio',
             'instances': [],
+            'maxmemory-ttl': 300,
+            'threads': 4,
+            'deadline': None,
+            'slowlog': False,
+            'slowlog-max-entries': 128,
+            'slowlog-top': 10,
+            'latency': False,
+            'commands': [],
         })
         return config
 
-    def _client(self, host, port, auth):
-        """ Return a redis client for the configuration.
+    def _client(self, nick, host, port, auth):
+        """ Return the redis client of an instance, created on first use.
 
-            :param str host: redis host
-            :param int port: redis port
+            :param str nick: nickname of redis instance
+            :param str host: redis host, or path of the unix socket
+            :param int port: redis port, None for a unix socket
             :rtype: redis.Redis
 
         """
-        db = int(self.config['db'])
-        timeout = int(self.config['timeout'])
-        try:
-            cli = redis.Redis(host=host, port=port,
-                              db=db, socket_timeout=timeout, password=auth)
-            cli.ping()
-            return cli
-        except Exception as ex:
-            self.log.error("OpenioRedisCollector:\
-                           failed to connect to %s:%i. %s.",
-                           host, port, ex)
+        client = self.clients.get(nick)
+        if client is None:
+            db = int(self.config['db'])
+            timeout = int(self.config['timeout'])
+            if port is None:
+                client = redis.Redis(unix_socket_path=host, db=db,
+                                     socket_timeout=timeout, password=auth)
+            else:
+                client = redis.Redis(host=host, port=port, db=db,
+                                     socket_timeout=timeout, password=auth)
+            self.clients[nick] = client
+        return client
 
     def _precision(self, value):
         """Return the precision of the number
@@ -157,49 +252,199 @@ class OpenioRedisCollector(diamond.collector.Collector):
             return 0
         return len(value) - decimal - 1
 
-    def _get_info(self, host, port, auth):
-        """Return info dict from specified Redis instance
+    def _get_info(self, nick, host, port, auth):
+        """Return info dict, maxmemory (None if unknown) and the optional
+        slowlog and latency replies from specified Redis instance, in one
+        round trip
 
+:param str nick: nickname of redis instance
 :param str host: redis host
 :param int port: redis port
-:rtype: dict
+:rtype: tuple
 
         """
+        client = self._client(nick, host, port, auth)
+        cached = self.maxmemory.get(nick)
+        fetch_maxmemory = cached is None or \
+            cached[1] + float(self.config['maxmemory-ttl']) < time.time()
+
+        slowlog = str_to_bool(self.config['slowlog'])
+        latency = str_to_bool(self.config['latency'])
+
+        pipe = client.pipeline(transaction=False)
+        for section in self._SECTIONS:
+            pipe.info(section)
+        if fetch_maxmemory:
+            pipe.config_get('maxmemory')
+        if slowlog:
+            pipe.slowlog_get(int(self.config['slowlog-max-entries']))
+        if latency:
+            pipe.execute_command('LATENCY', 'LATEST')
+        if self.commands:
+            pipe.info('commandstats')
+        try:
+            # Errors of single commands are returned in place of the reply
+            replies = pipe.execute(raise_on_error=False)
+        except Exception:
+            # Start over with a fresh connection next time
+            client.connection_pool.disconnect()
+            raise
+        now = time.time()
+        replies.reverse()
+
+        info = {}
+        for _section in self._SECTIONS:
+            reply = replies.pop()
+            if isinstance(reply, Exception):
+                raise reply
+            info.update(reply)
+        maxmemory = cached and cached[0]
+        extra = {'time': now}
+        for name, wanted in (('maxmemory', fetch_maxmemory),
+                             ('slowlog', slowlog), ('latency', latency),
+                             ('commandstats', bool(self.commands))):
+            if not wanted:
+                continue
+            reply = replies.pop()
+            if isinstance(reply, Exception):
+                self.log.debug("OpenioRedisCollector: no %s from %s. %s.",
+                               name, nick, reply)
+            elif name == 'maxmemory':
+                maxmemory = reply.get('maxmemory')
+                self.maxmemory[nick] = (maxmemory, now)
+            else:
+                extra[name] = reply
+        return info, maxmemory, extra
 
-        client = self._client(host, port, auth)
-        if client is None:
-            return None
-
-        info = client.info()
-        del client
-        return info
+    def _command_name(self, command):
+        """Return the metric name of a command of the slowlog"""
+        if isinstance(command, bytes):
+            command = command.decode('utf-8', 'replace')
+        name = command.split(None, 1)[0].lower() if command else ''
+        return re.sub(r'[^a-z0-9_]', '_', name) or 'unknown'
 
-    def _get_config(self, host, port, auth, config_key):
-        """Return config string from specified Redis instance and config key
+    def _slowlog_data(self, nick, entries):
+        """Return the metrics of the slowlog entries logged since the
+        previous cycle
 
-:param str host: redis host
-:param int port: redis port
-:param str host: redis config_key
-:rtype: str
+:param str nick: nickname of redis instance
+:param list entries: slowlog entries, newest first
+:rtype: dict
 
         """
+        first = nick not in self.slowlog_ids
+        # None while the slowlog has been empty: the ids do not start over
+        # after SLOWLOG RESET, the next one cannot be told
+        last = self.slowlog_ids.get(nick)
+        newest = entries[0]['id'] if entries else last
+        self.slowlog_ids[nick] = newest
+        if first:
+            # Only remember where the slowlog is on the first cycle
+            return {}
+        if last is not None and newest < last:
+            # Restarted instance, the ids start over
+            last = None
+
+        durations = {}
+        read = 0
+        for entry in entries:
+            if last is not None and entry['id'] <= last:
+                break
+            read += 1
+            durations.setdefault(self._command_name(entry['command']),
+                                 []).append(entry['duration'])
+
+        if last is None:
+            data = {'slowlog.count': read}
+        else:
+            # Entry ids follow each other, this counts the entries not read
+            # too
+            data = {'slowlog.count': int(newest - last)}
+        commands = sorted(durations.items(), key=lambda item: -len(item[1]))
+        top = int(self.config['slowlog-top'])
+        others = [d for _name, values in commands[top:] for d in values]
+        commands = commands[:top]
+        if others:
+            commands.append(('other', others))
+        for name, values in commands:
+            values.sort()
+            key = 'slowlog.%s.' % name
+            data[key + 'count'] = len(values)
+            data[key + 'p50'] = percentile(values, 50)
+            data[key + 'p99'] = percentile(values, 99)
+            data[key + 'max'] = values[-1]
+        return data
+
+    def _commands_data(self, nick, commandstats, now):
+        """Return calls per second and usec per call of the allowed
+        commands since the previous cycle
 
-        client = self._client(host, port, auth)
-        if client is None:
-            return None
-
-        config_value = client.config_get(config_key)
-        del client
-        return config_value
+:param str nick: nickname of redis instance
+:param dict commandstats: parsed INFO commandstats section
+:param float now: time of the sample
+:rtype: dict
 
-    def collect_instance(self, nick, namespace, host, port, auth):
-        """Collect metrics from a single Redis instance
+        """
+        data = {}
+        for key, prefix in self.commands:
+            stats = commandstats.get(key)
+            if stats is None:
+                # Not called since the instance started
+                continue
+            series = nick + '.' + key
+            calls = self.series.rate(series + '.calls', stats['calls'], now)
+            usec = self.series.rate(series + '.usec', stats['usec'], now)
+            if calls is None or usec is None:
+                continue
+            data[prefix + 'calls_per_sec'] = round(calls, 2)
+            if calls:
+                data[prefix + 'usec_per_call'] = round(usec / calls, 2)
+        return data
+
+    def _latency_data(self, events):
+        """Return the metrics of the LATENCY LATEST reply"""
+        data = {}
+        for event in events:
+            name, _timestamp, latest, highest = event[:4]
+            if isinstance(name, bytes):
+                name = name.decode('utf-8', 'replace')
+            key = 'latency.%s.' % re.sub(r'[^\w-]', '_', name)
+            data[key + 'latest'] = int(latest)
+            data[key + 'max'] = int(highest)
+        return data
+
+    def fetch_instance(self, nick, namespace, host, port, auth):
+        """Fetch the info of a single Redis instance, from a worker thread
 
 :param str nick: nickname of redis instance
 :param str namespace: namespace of the redis instance
 :param str host: redis host
 :param int port: redis port
 :param str auth: authentication password
+:rtype: tuple
+
+        """
+        # Get the info and the maxmemory config value
+        with self.phase('fetch'):
+            try:
+                result = self._get_info(nick, host, port, auth)
+            except Exception as ex:
+                self.log.error("OpenioRedisCollector: failed to get info"
+                               " from %s. %s.", nick, ex)
+                self.count('errors')
+                self.breakers.failure(nick)
+                return None
+        self.breakers.success(nick)
+        return result
+
+    def publish_instance(self, nick, namespace, info, maxmemory, extra):
+        """Publish the metrics of a single Redis instance
+
+:param str nick: nickname of redis instance
+:param str namespace: namespace of the redis instance
+:param dict info: merged INFO sections
+:param str maxmemory: maxmemory setting, None if unknown
+:param dict extra: slowlog and latency replies, when enabled
 
         """
 
@@ -207,21 +452,13 @@ class OpenioRedisCollector(diamond.collector.Collector):
         metric_prefix = '%s.redis.%s.' % (namespace,
                                           nick)
 
-        # Connect to redis and get the info
-        info = self._get_info(host, port, auth)
-        if info is None:
-            return
-
         # The structure should include the port for multiple instances per
         # server
         data = dict()
 
-        # Connect to redis and get the maxmemory config value
-        # Then calculate the % maxmemory of memory used
-        maxmemory_config = self._get_config(host, port, auth,
-                                            'maxmemory')
-        if maxmemory_config and 'maxmemory' in maxmemory_config.keys():
-            maxmemory = float(maxmemory_config['maxmemory'])
+        # Calculate the % maxmemory of memory used
+        if maxmemory is not None:
+            maxmemory = float(maxmemory)
 
             # Only report % used if maxmemory is a non zero value
             if maxmemory == 0:
@@ -254,13 +491,22 @@ class OpenioRedisCollector(diamond.collector.Collector):
             if key in info:
                 data['last_save.time_since'] = int(time.time()) - info[key]
 
+        if 'slowlog' in extra:
+            data.update(self._slowlog_data(nick, extra['slowlog']))
+        if 'latency' in extra:
+            data.update(self._latency_data(extra['latency']))
+        if 'commandstats' in extra:
+            data.update(self._commands_data(nick, extra['commandstats'],
+                                            extra['time']))
+
         # Publish the data to graphite
         for key in data:
-            self.publish(metric_prefix + key,
-                         data[key],
-                         precision=self._precision(data[key]),
-                         metric_type='GAUGE')
+            self.batch(metric_prefix + key,
+                       data[key],
+                       precision=self._precision(data[key]),
+                       metric_type='GAUGE')
 
+    @monitored
     def collect(self):
         """Collect the stats from the redis instance and publish them.
 
@@ -269,6 +515,18 @@ class OpenioRedisCollector(diamond.collector.Collector):
             self.log.error('Unable to import module redis')
             return {}
 
-        for nick in self.instances.keys():
-            (namespace, host, port, auth) = self.instances[nick]
-            self.collect_instance(nick, namespace, host, int(port), auth)
+        instances = dict(self.instances)
+        with self.phase('discovery'):
+            for namespace, host, port in self.discover():
+                discovered = '%s:%s' % (host.replace('.', '_'), port)
+                instances.setdefault(discovered, (namespace, host, port,
+                                                  self.config['auth']))
+
+        # Skip the instances which failed too many times in a row
+        jobs = [(nick, self.fetch_instance, (nick,) + instances[nick])
+                for nick in sorted(instances) if self.allow(nick)]
+        for nick, result in self.fanout.run(jobs, timeout=self.deadline):
+            if result is not None:
+                self.publish_instance(nick, instances[nick][0], *result)
+        # Forget the commands of the instances not answering for long
+        self.series.expire(time.time() - 10 * self.deadline)
@@ -0,0 +1,1191 @@
+# coding=utf-8
+
+"""
+Helpers shared by the OpenIO collectors
+
+This module does not define any collector, it is only imported by the
+collectors living in the same directory.
+
+"""
+
+import bisect
+import cProfile
+import errno
+import fcntl
+import functools
+import hashlib
+import heapq
+import itertools
+import json
+import marshal
+import math
+import os
+import re
+import stat
+import tempfile
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+from diamond.error import DiamondException
+from diamond.metric import Metric
+
+try:
+    from sys import intern
+except ImportError:
+    # Python 2, intern() is a builtin
+    pass
+
+# Only needed by the collectors discovering their instances
+try:
+    import urllib3
+except ImportError:
+    urllib3 = None
+try:
+    from oio.common.utils import load_namespace_conf
+except ImportError:
+    try:
+        from oio.common.configuration import load_namespace_conf
+    except ImportError:
+        load_namespace_conf = None
+
+# Where the conscience lists are shared between the collectors of a node
+DISCOVERY_CACHE = '/var/lib/diamond/openio'
+# Where the profiles of the cycles are dumped
+PROFILE_DIR = '/var/lib/diamond/openio/profiles'
+
+
+_INT_RE = re.compile(r'-?[0-9]+\Z')
+_FLOAT_RE = re.compile(
+    r'-?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?\Z')
+_METRIC_TYPES = {'counter': 'COUNTER', 'gauge': 'GAUGE'}
+
+
+def parse_number(value):
+    """Return a string as an int or a float, or None if it is not a number.
+
+    Unlike int() and float(), no exception is raised for strings which
+    are not numbers, which matters when most of them are not.
+    """
+    if _INT_RE.match(value):
+        return int(value)
+    if _FLOAT_RE.match(value):
+        return float(value)
+    return None
+
+
+_STAT_LINE_RE = re.compile(
+    r'^(\S+) (\S+) (-?(?:[0-9]+(\.[0-9]*)?|(\.)[0-9]+)([eE][-+]?[0-9]+)?)'
+    r'\r?$', re.M)
+
+
+def _intern(name):
+    try:
+        return intern(name)
+    except TypeError:
+        # unicode on Python 2
+        return name
+
+
+def private_directory(path):
+    """Create a directory only the current user may access, and refuse an
+    existing one someone else could write into
+
+    :raises OSError: when the directory cannot be used
+    """
+    try:
+        os.makedirs(path, 0o700)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.geteuid() or \
+            st.st_mode & 0o022:
+        raise OSError(errno.EPERM,
+                      "Not a directory private to uid %d" % os.geteuid(),
+                      path)
+
+
+def percentile(values, rank):
+    """Return the nearest-rank percentile of a sorted, non-empty list"""
+    index = int(math.ceil(rank / 100.0 * len(values))) - 1
+    return values[min(max(index, 0), len(values) - 1)]
+
+
+def _native(name):
+    """Return an ASCII unicode name as a str on Python 2, four times
+    smaller"""
+    if type(name) is not str:
+        try:
+            return str(name)
+        except UnicodeEncodeError:
+            pass
+    return name
+
+
+class MetricNames(dict):
+    """Names of the metrics of an instance, indexed by stat, built on first
+    use as (name, path) tuples, the path being the full one published by
+    Diamond, then reused from one cycle to the next.
+
+    The names are kept as str when they are ASCII, even if the prefix is
+    unicode (Python 2). All the names are dropped when there are more than
+    `size` of them, for example when tubes come and go. Misses are counted
+    in `misses`, without lock.
+    """
+
+    __slots__ = ('base', 'prefix', 'render', 'size', 'misses')
+
+    def __init__(self, base, prefix, render=None, size=100000):
+        super(MetricNames, self).__init__()
+        self.base = base
+        self.prefix = prefix
+        # Builds the name of a stat as render(prefix, stat)
+        self.render = render
+        self.size = size
+        self.misses = 0
+
+    def __missing__(self, stat):
+        if len(self) >= self.size:
+            self.clear()
+        self.misses += 1
+        if self.render is None:
+            name = self.prefix + stat
+        else:
+            name = self.render(self.prefix, stat)
+        name = _native(name)
+        found = self[stat] = (name, _native(self.base + name))
+        return found
+
+
+def iter_stat_lines(chunks, prefix, names=None):
+    """Parse the `type name value` lines of a stats body (rawx /stat, gridd
+    forward/stats) as they are read, ignoring non numeric values.
+
+    :param chunks: iterable of the successive chunks of the body
+    :param prefix: prefix of the names of the metrics, with its final dot
+    :param names: MetricNames the names are taken from, instead of prefix
+    :rtype: generator of (metric_name, metric_value, metric_type,
+        metric_path) tuples, metric_path is None without names
+    """
+    tail = ''
+    types = _METRIC_TYPES
+    for chunk in chunks:
+        if not isinstance(chunk, str):
+            chunk = chunk.decode('utf-8', 'replace')
+        chunk = tail + chunk
+        end = chunk.rfind('\n') + 1
+        tail = chunk[end:]
+        for match in _STAT_LINE_RE.finditer(chunk, 0, end):
+            metric_type, name, value, dot, dot2, exp = match.groups()
+            value = int(value) if dot is None and dot2 is None and \
+                exp is None else float(value)
+            if names is None:
+                name, path = prefix + name, None
+            else:
+                name, path = names[name]
+            yield (name, value, types.get(metric_type) or metric_type.upper(),
+                   path)
+    if tail:
+        for item in iter_stat_lines((tail + '\n',), prefix, names):
+            yield item
+
+
+class BatchPublisher(object):
+    """Mixin of the collectors which buffer the metrics of a cycle, and turn
+    them into Metric objects handed to the handlers all at once when the
+    cycle is over (see monitored()).
+
+    What the publish() of Diamond computes for every metric (path prefix,
+    hostname, TTL, timestamp) is computed once per flush, and the full path
+    of a metric is not even built again when it is given (see
+    MetricNames).
+    """
+
+    _batch = None
+
+    def batch(self, name, value, precision=0, metric_type='GAUGE',
+              path=None):
+        """Buffer a metric, with the same arguments as publish(), and its
+        full path if known"""
+        batch = self._batch
+        if batch is None:
+            batch = self._batch = []
+        batch.append((name, value, precision, metric_type, path))
+
+    def metric_names(self, prefix, render=None):
+        """Return a new MetricNames of this collector"""
+        return MetricNames(self.get_metric_path(''), prefix, render)
+
+    def flush_batch(self):
+        """Publish the buffered metrics
+
+        :returns: the number of metrics published
+        """
+        batch, self._batch = self._batch, None
+        if not batch:
+            return 0
+        whitelist = self.config.get('metrics_whitelist')
+        blacklist = self.config.get('metrics_blacklist')
+        base = self.get_metric_path('')
+        host = self.get_hostname()
+        ttl = float(self.config['interval']) * float(
+            self.config.get('ttl_multiplier', 2))
+        timestamp = int(time.time())
+        publish_metric = self.publish_metric
+        published = 0
+        for name, value, precision, metric_type, path in batch:
+            if whitelist:
+                if not whitelist.match(name):
+                    continue
+            elif blacklist and blacklist.match(name):
+                continue
+            try:
+                metric = Metric(path or base + name, value,
+                                timestamp=timestamp, precision=precision,
+                                host=host, metric_type=metric_type, ttl=ttl)
+            except DiamondException:
+                self.log.error("Error when creating new Metric: %s = %s",
+                               name, value)
+                continue
+            publish_metric(metric)
+            published += 1
+        return published
+
+
+class BreakerOpen(Exception):
+    """Raised instead of calling an endpoint whose circuit breaker is open"""
+
+
+class _Breaker(object):
+
+    __slots__ = ('failures', 'retry_at', 'backoff', 'trying', 'asked_at')
+
+    def __init__(self, backoff, now):
+        self.failures = 0
+        self.retry_at = None
+        self.backoff = backoff
+        self.trying = False
+        self.asked_at = now
+
+
+class CircuitBreakers(object):
+    """One circuit breaker per endpoint (proxy, service, redis...).
+
+    A breaker opens after `threshold` consecutive failures of its endpoint,
+    which is then skipped for `backoff` seconds. A single attempt is then
+    let through (half open): a success closes the breaker, a failure opens
+    it again for twice as long, up to `max_backoff` seconds. Only the
+    endpoints which failed recently are tracked, and those no longer
+    called (allow() not asked for `max_backoff` seconds) are forgotten
+    by states(). Thread safe.
+    """
+
+    CLOSED = 0
+    OPEN = 1
+    HALF_OPEN = 2
+
+    def __init__(self, threshold, backoff, max_backoff, clock=time.time):
+        self.threshold = max(1, int(threshold))
+        self.backoff = float(backoff)
+        self.max_backoff = float(max_backoff)
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._failing = {}
+        self._recovered = set()
+
+    def allow(self, endpoint):
+        """Tell whether an endpoint may be called now"""
+        with self._lock:
+            breaker = self._failing.get(endpoint)
+            if breaker is None:
+                return True
+            now = breaker.asked_at = self.clock()
+            if breaker.retry_at is None:
+                return True
+            if breaker.trying or now < breaker.retry_at:
+                return False
+            breaker.trying = True
+            return True
+
+    def success(self, endpoint):
+        with self._lock:
+            if self._failing.pop(endpoint, None) is not None:
+                self._recovered.add(endpoint)
+
+    def failure(self, endpoint):
+        with self._lock:
+            now = self.clock()
+            breaker = self._failing.get(endpoint)
+            if breaker is None:
+                breaker = self._failing[endpoint] = _Breaker(self.backoff,
+                                                             now)
+                self._recovered.discard(endpoint)
+            breaker.failures += 1
+            if breaker.trying:
+                breaker.trying = False
+                breaker.backoff = min(breaker.backoff * 2, self.max_backoff)
+            if breaker.failures >= self.threshold:
+                breaker.retry_at = now + breaker.backoff
+
+    def states(self):
+        """Return the state of the endpoints which failed recently, and of
+        those which recovered since the previous call
+
+        :rtype: dict of CLOSED, OPEN or HALF_OPEN, indexed by endpoint
+        """
+        with self._lock:
+            states = dict.fromkeys(self._recovered, self.CLOSED)
+            self._recovered = set()
+            forgotten = self.clock() - self.max_backoff
+            for endpoint, breaker in list(self._failing.items()):
+                if breaker.asked_at < forgotten:
+                    # Removed from the configuration or from the conscience
+                    del self._failing[endpoint]
+                elif breaker.trying:
+                    states[endpoint] = self.HALF_OPEN
+                elif breaker.retry_at is not None:
+                    states[endpoint] = self.OPEN
+                else:
+                    states[endpoint] = self.CLOSED
+            return states
+
+
+class SelfMonitor(BatchPublisher):
+    """Mixin of the collectors publishing metrics about themselves under
+    SELF_PREFIX: the time spent in each phase of a cycle (`time.<phase>`),
+    the number of errors and timeouts, and the number of metrics published.
+
+    When the file named by `profile-trigger` exists, the next cycle is run
+    under cProfile (main thread only), its stats are dumped in a new file
+    of `profile-dir` and the trigger is removed. Both directories must be
+    private to the user running Diamond (see private_directory()).
+
+    Calls to the endpoints go through circuit breakers (see guarded()),
+    whose state is published as `breaker.<endpoint>` (0 closed, 1 open,
+    2 half open) along with the number of open breakers (`breakers_open`)
+    and the number of calls skipped (`skipped`).
+
+    The share of the names of metrics found in a MetricNames is published
+    as `names.hit_rate`, see count_names().
+    """
+
+    SELF_PREFIX = 'collector'
+    SELF_COUNTS = ('errors', 'timeouts', 'skipped')
+
+    def process_config(self):
+        super(SelfMonitor, self).process_config()
+        self._self_lock = threading.Lock()
+        self._self_timings = {}
+        self._self_counts = dict.fromkeys(self.SELF_COUNTS, 0)
+        # [lookups, misses] of names
+        self._self_names = [0, 0]
+        self.breakers = CircuitBreakers(self.config['breaker-threshold'],
+                                        self.config['breaker-backoff'],
+                                        self.config['breaker-max-backoff'])
+
+    def get_default_config_help(self):
+        config_help = super(SelfMonitor, self).get_default_config_help()
+        config_help.update({
+            'breaker-threshold': "Consecutive failures of an endpoint"
+                                 " after which it is skipped",
+            'breaker-backoff': "Seconds an endpoint is first skipped for,"
+                               " doubled after each failed retry",
+            'breaker-max-backoff': "Maximum number of seconds an endpoint"
+                                   " is skipped for",
+            'profile-trigger': "Profile the next cycle when this file"
+                               " exists",
+            'profile-dir': "Directory where the profiles are dumped",
+        })
+        return config_help
+
+    def get_default_config(self):
+        config = super(SelfMonitor, self).get_default_config()
+        config.update({
+            'profile-trigger': None,
+            'profile-dir': PROFILE_DIR,
+            'breaker-threshold': 3,
+            'breaker-backoff': 30,
+            'breaker-max-backoff': 600,
+        })
+        return config
+
+    def add_time(self, name, seconds):
+        """Account time spent in a phase, may be called by any thread"""
+        with self._self_lock:
+            self._self_timings[name] = \
+                self._self_timings.get(name, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name):
+        """Account the time spent in the block to a phase"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    def count(self, name, value=1):
+        """Increment a self counter, may be called by any thread"""
+        with self._self_lock:
+            self._self_counts[name] = self._self_counts.get(name, 0) + value
+
+    def count_names(self, names, lookups):
+        """Account `lookups` names taken from a MetricNames, and its misses
+        since the previous call, may be called by any thread"""
+        misses, names.misses = names.misses, 0
+        with self._self_lock:
+            self._self_names[0] += lookups
+            self._self_names[1] += misses
+
+    def allow(self, endpoint):
+        """Tell whether an endpoint may be called, counting the calls
+        skipped because its breaker is open"""
+        if self.breakers.allow(endpoint):
+            return True
+        self.count('skipped')
+        return False
+
+    def guarded(self, endpoint, func, *args, **kwargs):
+        """Call func through the circuit breaker of an endpoint: any
+        exception raised is a failure of the endpoint
+
+        :raises BreakerOpen: when the breaker of the endpoint is open
+        """
+        if not self.allow(endpoint):
+            raise BreakerOpen("%s skipped after repeated failures"
+                              % endpoint)
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.breakers.failure(endpoint)
+            raise
+        self.breakers.success(endpoint)
+        return result
+
+    def start_profiler(self):
+        trigger = self.config.get('profile-trigger')
+        if not trigger or not os.path.exists(trigger):
+            return None
+        try:
+            private_directory(os.path.dirname(os.path.abspath(trigger)))
+            os.remove(trigger)
+        except OSError as exc:
+            self.log.error("Ignoring profile trigger %s: %s", trigger, exc)
+            return None
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def stop_profiler(self, profiler):
+        profiler.disable()
+        directory = self.config['profile-dir']
+        try:
+            private_directory(directory)
+            fd, path = tempfile.mkstemp(
+                '.prof', '%s-%d-' % (self.__class__.__name__,
+                                     int(time.time())), directory)
+            with os.fdopen(fd, 'wb') as dump:
+                # What dump_stats() does, without opening the path again
+                profiler.create_stats()
+                marshal.dump(profiler.stats, dump)
+            self.log.info("Profile of the cycle dumped in %s", path)
+        except (IOError, OSError) as exc:
+            self.log.error("Unable to dump profile in %s: %s", directory,
+                           exc)
+
+    def publish_self_metrics(self, duration, published):
+        with self._self_lock:
+            timings, self._self_timings = self._self_timings, {}
+            counts = self._self_counts
+            self._self_counts = dict.fromkeys(self.SELF_COUNTS, 0)
+            (lookups, misses), self._self_names = self._self_names, [0, 0]
+        prefix = self.SELF_PREFIX
+        self.batch(prefix + '.time.cycle', duration, precision=3)
+        for name, seconds in timings.items():
+            self.batch('%s.time.%s' % (prefix, name), seconds, precision=3)
+        for name, value in counts.items():
+            self.batch('%s.%s' % (prefix, name), value)
+        opened = 0
+        for endpoint, state in self.breakers.states().items():
+            opened += state != CircuitBreakers.CLOSED
+            self.batch('%s.breaker.%s' % (
+                prefix, endpoint.split('//', 1)[-1].replace('.', '_')), state)
+        self.batch(prefix + '.breakers_open', opened)
+        if lookups:
+            self.batch(prefix + '.names.hit_rate',
+                       1 - float(misses) / lookups, precision=3)
+        self.batch(prefix + '.metrics', published)
+        self.flush_batch()
+
+
+def monitored(collect):
+    """Decorate the collect() method of a SelfMonitor: the metrics of the
+    cycle are flushed once it is over, then the self metrics"""
+    @functools.wraps(collect)
+    def _collect(self, *args, **kwargs):
+        profiler = self.start_profiler()
+        start = time.time()
+        try:
+            return collect(self, *args, **kwargs)
+        finally:
+            with self.phase('publish'):
+                published = self.flush_batch()
+            if profiler is not None:
+                self.stop_profiler(profiler)
+            self.publish_self_metrics(time.time() - start, published)
+    return _collect
+
+
+class SeriesStore(object):
+    """Last sample (value and time) of many series.
+
+    Samples are kept in two flat arrays of doubles, the slot of each series
+    being found through a dict of interned names, instead of one object per
+    series.
+    """
+
+    def __init__(self):
+        self._slots = {}
+        self._values = array('d')
+        self._times = array('d')
+        self._free = []
+
+    def __len__(self):
+        return len(self._slots)
+
+    def get(self, name):
+        """Return the last sample of a series as a (value, time) tuple, or
+        None if it is unknown"""
+        slot = self._slots.get(name)
+        if slot is None:
+            return None
+        return self._values[slot], self._times[slot]
+
+    def set(self, name, value, now):
+        slot = self._slots.get(name)
+        if slot is None:
+            if self._free:
+                slot = self._free.pop()
+                self._values[slot] = value
+                self._times[slot] = now
+            else:
+                slot = len(self._values)
+                self._values.append(value)
+                self._times.append(now)
+            self._slots[_intern(name)] = slot
+        else:
+            self._values[slot] = value
+            self._times[slot] = now
+
+    def swap(self, name, value, now):
+        """Store a sample and return the previous one, like get()"""
+        previous = self.get(name)
+        self.set(name, value, now)
+        return previous
+
+    def rate(self, name, value, now):
+        """Store a sample of a counter and return its per second rate since
+        the previous sample, or None when there is no previous sample or
+        when the counter has been reset (e.g. by a restart)"""
+        previous = self.swap(name, value, now)
+        if previous is None:
+            return None
+        prev_value, prev_time = previous
+        if value < prev_value or now <= prev_time:
+            return None
+        return (value - prev_value) / (now - prev_time)
+
+    def expire(self, before):
+        """Forget the series without any sample since a given time
+
+        :returns: the number of series forgotten
+        """
+        times = self._times
+        expired = [name for name, slot in self._slots.items()
+                   if times[slot] < before]
+        for name in expired:
+            self._free.append(self._slots.pop(name))
+        return len(expired)
+
+
+class FanOut(object):
+    """Run jobs on a bounded pool of worker threads.
+
+    The pool is created on first use, so that it belongs to the process
+    actually running the collector, and then lives as long as the collector.
+    """
+
+    def __init__(self, width, log=None, monitor=None):
+        self.width = max(1, int(width))
+        self.log = log
+        self.monitor = monitor
+        self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ThreadPool(self.width)
+        return self._pool
+
+    def run(self, jobs, timeout=None):
+        """Run every job concurrently and yield the results in submission
+        order, as soon as each of them is available.
+
+        :param jobs: iterable of (key, callable, args) tuples
+        :param timeout: seconds allowed for the whole batch, None to wait
+            for every job
+        :rtype: generator of (key, result) tuples, result is None when the
+            job failed or did not finish in time
+        """
+        pool = self._get_pool()
+        pending = [(key, pool.apply_async(func, args))
+                   for key, func, args in jobs]
+        deadline = None if timeout is None else time.time() + timeout
+        for key, res in pending:
+            try:
+                if deadline is None:
+                    # A finite value keeps the wait interruptible on py2
+                    result = res.get(1 << 31)
+                else:
+                    result = res.get(max(0, deadline - time.time()))
+            except TimeoutError:
+                if self.log:
+                    self.log.error("Timed out waiting for %s", key)
+                if self.monitor:
+                    self.monitor.count('timeouts')
+                result = None
+            except Exception as exc:
+                if self.log:
+                    self.log.error("Job %s failed: %s", key, exc)
+                if self.monitor:
+                    self.monitor.count('errors')
+                result = None
+            yield key, result
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+
+class Watchdog(object):
+    """Call functions at their deadline, unless they are cancelled before.
+
+    A single thread, started on first use, waits for all the deadlines,
+    instead of one timer thread per deadline.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._thread = None
+
+    def arm(self, deadline, func, *args):
+        """Call func(*args) at `deadline`
+
+        :returns: the handle to give to cancel()
+        """
+        entry = [deadline, next(self._seq), func, args]
+        with self._cond:
+            heapq.heappush(self._heap, entry)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run,
+                                                name='watchdog')
+                self._thread.daemon = True
+                self._thread.start()
+            if self._heap[0] is entry:
+                self._cond.notify()
+        return entry
+
+    def cancel(self, entry):
+        with self._cond:
+            entry[2] = None
+            if self._heap and self._heap[0] is entry:
+                # Let the thread drop it, and wait for the next one
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    while self._heap and self._heap[0][2] is None:
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    delay = self._heap[0][0] - time.time()
+                    if delay <= 0:
+                        break
+                    self._cond.wait(delay)
+                _deadline, _seq, func, args = heapq.heappop(self._heap)
+            try:
+                func(*args)
+            except Exception:
+                pass
+
+
+class HashRing(object):
+    """Consistent hashing of keys (service addresses) over nodes (collector
+    hosts): adding or removing a node only moves the keys of its share of
+    the ring. Each node is placed `replicas` times on the ring to even the
+    shares out.
+    """
+
+    def __init__(self, nodes, replicas=100):
+        ring = sorted((self._hash('%s-%d' % (node, i)), node)
+                      for node in set(nodes) for i in range(int(replicas)))
+        self._hashes = [h for h, _node in ring]
+        self._nodes = [node for _h, node in ring]
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:8], 16)
+
+    def get(self, key):
+        """Return the node in charge of a key"""
+        if not self._nodes:
+            return None
+        index = bisect.bisect(self._hashes, self._hash(key))
+        return self._nodes[index % len(self._nodes)]
+
+
+class Scheduler(object):
+    """Tell which groups of work are due in a cycle of a collector, each
+    group having its own interval.
+
+    A group is due when its interval has elapsed since it last ran, give or
+    take half the interval of the collector, so that a group whose interval
+    is a multiple of the collector one is not delayed by a cycle because of
+    scheduling jitter. Groups without interval are due in every cycle.
+    """
+
+    def __init__(self, groups, intervals, tick):
+        self.groups = tuple(groups)
+        self.intervals = dict(intervals)
+        self.slack = float(tick) / 2
+        self._last = {}
+
+    def due(self, now=None):
+        """Return the set of groups to run now, and mark them as run"""
+        if now is None:
+            now = time.time()
+        due = set()
+        for group in self.groups:
+            interval = self.intervals.get(group)
+            last = self._last.get(group)
+            if not interval or last is None or \
+                    now - last + self.slack >= interval:
+                due.add(group)
+                self._last[group] = now
+        return due
+
+
+class Service(object):
+    """A service registered in the conscience, with the prefix of its
+    metrics built once for all, and the names of its metrics (see
+    MetricNames), dropped along with it once it is no longer registered"""
+
+    __slots__ = ('namespace', 'srvtype', 'addr', 'prefix', 'score', 'tags',
+                 'names')
+
+    def __init__(self, namespace, srvtype, addr):
+        self.namespace = namespace
+        self.srvtype = srvtype
+        self.addr = addr
+        self.prefix = "%s.%s.%s" % (namespace, srvtype, addr.replace('.', '_'))
+        self.score = None
+        self.tags = {}
+        self.names = None
+
+    def update(self, desc):
+        self.score = desc.get('score')
+        self.tags = desc.get('tags') or {}
+
+
+class ConscienceCache(object):
+    """Cache the namespace configurations, the service types and the
+    services listed by the conscience for a few seconds.
+
+    Services lists are merged into the previous ones, so that the Service
+    of an address which is still registered is kept as is. When a refresh
+    fails, the previous data is served until the next attempt.
+    """
+
+    def __init__(self, ttl, conf_ttl, log=None):
+        self.ttl = float(ttl)
+        self.conf_ttl = float(conf_ttl)
+        self.log = log
+        self._confs = {}
+        self._types = {}
+        # (namespace, srvtype) -> (refresh time, {addr: Service})
+        self._services = {}
+
+    def _get(self, store, key, ttl, fetch, what, merge=None):
+        now = time.time()
+        entry = store.get(key)
+        if entry is not None and now - entry[0] < ttl:
+            return entry[1]
+        try:
+            value = fetch()
+        except Exception as exc:
+            value = None
+            if self.log:
+                self.log.error("Unable to refresh %s %s: %s", what, key, exc)
+        if not value and not isinstance(value, list):
+            # Serve stale data, and retry on next call
+            return entry[1] if entry is not None else value
+        if merge is not None:
+            value = merge(key, entry[1] if entry is not None else {}, value)
+        store[key] = (now, value)
+        return value
+
+    def namespace_conf(self, namespace, load):
+        """Return the configuration of a namespace, as loaded by load()"""
+        return self._get(self._confs, namespace, self.conf_ttl,
+                         lambda: load(namespace), 'configuration of')
+
+    def service_types(self, namespace, fetch, max_age=None):
+        """Return the service types of a namespace, as listed by fetch()
+
+        :param max_age: age above which the cached list is refreshed,
+            defaults to the TTL of the cache
+        """
+        return self._get(self._types, namespace,
+                         self.ttl if max_age is None else max_age, fetch,
+                         'service types of')
+
+    def services(self, namespace, srvtype, fetch, max_age=None):
+        """Return the services of a type, as listed by fetch()
+
+        :param max_age: age above which the cached list is refreshed,
+            defaults to the TTL of the cache
+        :rtype: OrderedDict of Service, indexed by sorted address
+        """
+        return self._get(self._services, (namespace, srvtype),
+                         self.ttl if max_age is None else max_age, fetch,
+                         'services of', merge=self._merge)
+
+    def _merge(self, key, previous, listing):
+        namespace, srvtype = key
+        services = OrderedDict()
+        for desc in sorted(listing, key=lambda d: d.get('addr') or ''):
+            addr = desc.get('addr')
+            if not addr:
+                continue
+            service = previous.get(addr)
+            if service is None:
+                service = Service(namespace, srvtype, addr)
+            service.update(desc)
+            services[addr] = service
+        if self.log:
+            added = len(set(services).difference(previous))
+            removed = len(set(previous).difference(services))
+            if added or removed:
+                self.log.debug("%s %s services: %d added, %d removed",
+                               namespace, srvtype, added, removed)
+        return services
+
+
+def conscience_key(namespace, srvtype):
+    """Key of the services of a type in a SharedCache"""
+    return 'conscience.%s.%s' % (namespace, srvtype)
+
+
+class SharedCache(object):
+    """Cache of JSON documents in files, shared by the collectors of a node,
+    which Diamond runs in distinct processes.
+
+    A document older than `ttl` is fetched again by the first process
+    needing it while the others wait for it, and the stale one is served
+    when the fetch fails.
+
+    The directory must belong to the user running Diamond and must not be
+    writable by anyone else (see private_directory()), otherwise documents
+    are fetched without being shared.
+    """
+
+    def __init__(self, directory, ttl, log=None):
+        self.directory = directory
+        self.ttl = float(ttl)
+        self.log = log
+
+    def _path(self, key):
+        return os.path.join(self.directory,
+                            re.sub(r'[^\w.-]', '_', key) + '.json')
+
+    def _load(self, path, ttl):
+        try:
+            if ttl is not None and \
+                    os.stat(path).st_mtime + ttl < time.time():
+                return None
+            with open(path) as cached:
+                return json.load(cached)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def put(self, key, data):
+        """Share a document, failures are only logged"""
+        try:
+            private_directory(self.directory)
+            tmp = tempfile.NamedTemporaryFile(
+                'w', dir=self.directory, prefix='.', delete=False)
+            with tmp:
+                json.dump(data, tmp)
+            os.rename(tmp.name, self._path(key))
+        except (IOError, OSError) as exc:
+            if self.log:
+                self.log.debug("Unable to share %s: %s", key, exc)
+
+    def through(self, key, fetch):
+        """Fetch a document and share it"""
+        data = fetch()
+        self.put(key, data)
+        return data
+
+    def get(self, key, fetch):
+        """Return a document, fetched and shared if missing or too old"""
+        try:
+            private_directory(self.directory)
+        except OSError as exc:
+            if self.log:
+                self.log.error("Unable to share %s: %s", key, exc)
+            try:
+                return fetch()
+            except Exception as exc:
+                if self.log:
+                    self.log.error("Unable to refresh %s: %s", key, exc)
+                return None
+        path = self._path(key)
+        data = self._load(path, self.ttl)
+        if data is not None:
+            return data
+        try:
+            lock = os.open(path + '.lock',
+                           os.O_WRONLY | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        except OSError:
+            lock = None
+        try:
+            if lock is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                # Maybe refreshed by another process meanwhile
+                data = self._load(path, self.ttl)
+                if data is not None:
+                    return data
+            try:
+                return self.through(key, fetch)
+            except Exception as exc:
+                if self.log:
+                    self.log.error("Unable to refresh %s: %s", key, exc)
+                return self._load(path, None)
+        finally:
+            if lock is not None:
+                os.close(lock)
+
+
+class ConscienceDiscovery(object):
+    """Mixin of the collectors finding their local instances among the
+    services registered in the conscience of `discovery-namespaces`.
+
+    The lists are read through a SharedCache, also fed by
+    OpenIOSDSCollector, so that the proxy is queried once per node.
+    """
+
+    # Service types of the instances, overridden by 'discovery-types'
+    DISCOVERY_TYPES = ()
+
+    def process_config(self):
+        super(ConscienceDiscovery, self).process_config()
+        namespaces = self.config['discovery-namespaces'] or []
+        if isinstance(namespaces, basestring):
+            namespaces = [namespaces]
+        self.discovery_namespaces = [n.strip() for n in namespaces
+                                     if n.strip()]
+        types = self.config['discovery-types'] or []
+        if isinstance(types, basestring):
+            types = [types]
+        self.discovery_types = [t.strip() for t in types if t.strip()]
+        self.discovery_cache = SharedCache(
+            self.config['discovery-cache'] or DISCOVERY_CACHE,
+            self.config['discovery-ttl'], log=self.log)
+        self._discovery_http = None
+
+    def get_default_config_help(self):
+        config_help = super(ConscienceDiscovery,
+                            self).get_default_config_help()
+        config_help.update({
+            'discovery-namespaces': "Namespaces whose local instances are"
+                                    " collected, besides 'instances'",
+            'discovery-types': "Service types of the instances",
+            'discovery-cache': "Directory of the conscience lists shared"
+                               " by the collectors, private to the user"
+                               " running Diamond",
+            'discovery-ttl': "Seconds a shared conscience list is used",
+        })
+        return config_help
+
+    def get_default_config(self):
+        config = super(ConscienceDiscovery, self).get_default_config()
+        config.update({
+            'discovery-namespaces': [],
+            'discovery-types': list(self.DISCOVERY_TYPES),
+            'discovery-cache': DISCOVERY_CACHE,
+            'discovery-ttl': 60,
+        })
+        return config
+
+    def _list_services(self, proxy, namespace, srvtype):
+        if self._discovery_http is None:
+            self._discovery_http = urllib3.PoolManager(
+                num_pools=1, timeout=urllib3.Timeout(connect=1.0, read=5.0))
+        url = "%s/v3.0/%s/conscience/list?type=%s" % (
+            proxy, namespace, srvtype)
+        return json.loads(self._discovery_http.request('GET', url).data)
+
+    def discover_extra(self, namespace, conf):
+        """Return the addresses of instances not registered in the
+        conscience, found in the configuration of the namespace"""
+        return []
+
+    def discover(self):
+        """Return the (namespace, host, port) of the local instances"""
+        if not self.discovery_namespaces:
+            return []
+        if load_namespace_conf is None or urllib3 is None:
+            self.log.error("Discovery needs the oio and urllib3 modules")
+            return []
+        found = []
+        for namespace in self.discovery_namespaces:
+            try:
+                conf = load_namespace_conf(namespace)
+            except Exception as exc:
+                self.log.error("No configuration found for namespace %s: %s",
+                               namespace, exc)
+                continue
+            proxy = conf.get('proxy') if conf else None
+            if not proxy:
+                continue
+            # assume that all local services are listening
+            # on the same IP address as the proxy
+            proxy_ip = proxy.split('//', 1)[-1].split(":", 1)[0] + ":"
+            addrs = list(self.discover_extra(namespace, conf))
+            for srvtype in self.discovery_types:
+                services = self.discovery_cache.get(
+                    conscience_key(namespace, srvtype),
+                    functools.partial(self.guarded, proxy,
+                                      self._list_services, proxy, namespace,
+                                      srvtype))
+                addrs.extend(s['addr'] for s in services or ())
+            for addr in addrs:
+                if addr.startswith(proxy_ip):
+                    host, port = addr.rsplit(':', 1)
+                    found.append((namespace, host, int(port)))
+        return found
+
+
+class VolumeIndex(object):
+    """Map a path to the device holding it and to the UUID of that device.
+
+    The index is built from /proc/self/mountinfo and /dev/disk/by-uuid, and
+    is only rebuilt when one of them changes, so that resolving a volume
+    does not fork any process.
+    """
+
+    MOUNTINFO = '/proc/self/mountinfo'
+    BY_UUID = '/dev/disk/by-uuid'
+
+    _ESCAPE_RE = re.compile(r'\\([0-7]{3})')
+
+    def __init__(self):
+        self._mountinfo = None
+        self._by_uuid_mtime = None
+        # (mount point, device, major:minor), longest mount point first
+        self._mounts = []
+        # device path or major:minor -> UUID
+        self._uuids = {}
+        # volume -> filesystem resolved by other means, see remember()
+        self._fallback = {}
+
+    def _unescape(self, path):
+        return self._ESCAPE_RE.sub(lambda m: chr(int(m.group(1), 8)), path)
+
+    def refresh(self):
+        """Rebuild the index if the mount table or the UUID links changed
+
+        :returns: True if the index has been rebuilt
+        """
+        try:
+            with open(self.MOUNTINFO) as mountinfo:
+                data = mountinfo.read()
+        except (IOError, OSError):
+            data = None
+        try:
+            by_uuid_mtime = os.stat(self.BY_UUID).st_mtime
+        except OSError:
+            by_uuid_mtime = None
+        if (data == self._mountinfo and
+                by_uuid_mtime == self._by_uuid_mtime):
+            return False
+        self._mountinfo = data
+        self._by_uuid_mtime = by_uuid_mtime
+
+        mounts = []
+        # Latest mounts first, they hide the earlier ones on the same path
+        for line in reversed((data or '').splitlines()):
+            # 36 35 98:0 /mnt1 /mnt/parent rw master:1 - ext3 /dev/root rw
+            fields = line.split()
+            try:
+                sep = fields.index('-', 6)
+                mounts.append((self._unescape(fields[4]),
+                               self._unescape(fields[sep + 2]),
+                               fields[2]))
+            except (ValueError, IndexError):
+                continue
+        mounts.sort(key=lambda m: len(m[0]), reverse=True)
+
+        uuids = {}
+        try:
+            names = os.listdir(self.BY_UUID)
+        except OSError:
+            names = []
+        for name in names:
+            device = os.path.realpath(os.path.join(self.BY_UUID, name))
+            uuids[device] = name
+            try:
+                rdev = os.stat(device).st_rdev
+                uuids['%d:%d' % (os.major(rdev), os.minor(rdev))] = name
+            except OSError:
+                pass
+
+        self._mounts = mounts
+        self._uuids = uuids
+        # Anything resolved by other means is now possibly stale
+        self._fallback = {}
+        return True
+
+    def remember(self, volume, filesystem):
+        """Keep the filesystem of a volume resolved by other means, until
+        the next rebuild of the index"""
+        self._fallback[volume] = filesystem
+
+    def recall(self, volume):
+        return self._fallback.get(volume)
+
+    def lookup(self, volume):
+        """Find the mounted filesystem holding a path
+
+        :returns: (device, uuid) tuple, uuid is None when the device has
+            none, or None when the path is not covered by the index
+        """
+        path = os.path.realpath(volume)
+        for mount_point, device, majmin in self._mounts:
+            if (path == mount_point or mount_point == '/' or
+                    path.startswith(mount_point + '/')):
+                uuid = self._uuids.get(majmin) or self._uuids.get(
+                    os.path.realpath(device))
+                return device, uuid
+        return None
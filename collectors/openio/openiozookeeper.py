@@ -22,17 +22,66 @@ TO use a unix socket, set a host string like this
 ```
     hosts = /path/to/blah.sock, app-1@/path/to/bleh.sock,
 ```
+
+All the instances (e.g. the members of an ensemble) are queried at once, by
+up to `threads` workers, and each reply is read until the server closes
+the connection, within `timeout` seconds per command.
+
+Besides the `mntr` values, each instance publishes:
+ * `zk_is_leader`, 1 on the leader (or a standalone server), 0 otherwise
+ * `zk_server_role`, 0 standalone, 1 leader, 2 follower, 3 observer
+ * `zk_packets_received_per_sec` and `zk_packets_sent_per_sec`
+ * `zk_outstanding_requests_delta`, change since the previous cycle
+
+With `cons` enabled, the connections listed by `cons` are summed up by
+client address, and the `cons-top` addresses with the highest max latency
+are published under `clients.<address>` (`connections`, `avg_latency` and
+`max_latency`, in milliseconds), along with `zk_client_addresses`. With
+`wchs` enabled, `zk_watching_connections`, `zk_watched_paths` and
+`zk_total_watches` are published. Both commands must be allowed by
+`4lw.commands.whitelist` on ZooKeeper 3.5 and later.
+
+With `discovery-namespaces` set, the local members of the ensemble listed
+by the `zookeeper` key of the configuration of those namespaces are
+collected too, as well as the local services of `discovery-types`, if any.
+
+The time spent querying the instances, and the number of errors, are
+published under `collector.zookeeper`. An instance failing
+`breaker-threshold` times in a row is skipped for a while, see
+`collector.zookeeper.breaker`.
 """
 
 import diamond.collector
+import re
 import socket
+import time
+
+from diamond.collector import str_to_bool
+from openioutils import ConscienceDiscovery, FanOut, SelfMonitor, \
+    SeriesStore, monitored, parse_number
+
 
+class OpenioZookeeperCollector(ConscienceDiscovery, SelfMonitor,
+                               diamond.collector.Collector):
 
-class OpenioZookeeperCollector(diamond.collector.Collector):
+    SELF_PREFIX = 'collector.zookeeper'
+    ROLES = {'standalone': 0, 'leader': 1, 'follower': 2, 'observer': 3}
+    RATES = ('zk_packets_received', 'zk_packets_sent')
+    # ' /10.0.0.1:41234[1](queued=0,recved=5,...,avglat=0,maxlat=3)'
+    CONS_RE = re.compile(r'\s*/(.+):\d+\[\d+\]\((.*)\)')
+    AVGLAT_RE = re.compile(r'avglat=(\d+)')
+    MAXLAT_RE = re.compile(r'maxlat=(\d+)')
+    WCHS_RE = re.compile(r'(\d+) connections watching (\d+) paths')
+    TOTAL_WATCHES_RE = re.compile(r'Total watches:\s*(\d+)')
 
     def process_config(self):
         super(OpenioZookeeperCollector, self).process_config()
-        self.instances = self.config['instances'] or 'OPENIO:localhost:6005'
+        self.instances = self.config.get('instances') or []
+        if not self.instances and not self.discovery_namespaces:
+            self.instances = 'OPENIO:localhost:6005'
+        self.fanout = FanOut(self.config['threads'], log=self.log,
+                             monitor=self)
+        self.series = SeriesStore()
 
     def get_default_config_help(self):
         config_help = super(OpenioZookeeperCollector, self)\
@@ -44,6 +93,18 @@ class OpenioZookeeperCollector(diamond.collector.Collector):
                 " list of possibilities. Leave unset to publish all.",
             'instances':
                 "List of namespaces, hosts, and ports to collect.",
+            'timeout':
+                "Seconds allowed to connect to an instance and read its" +
+                " reply",
+            'threads':
+                "Number of instances queried at once",
+            'cons':
+                "Publish the latencies of the clients, from 'cons'",
+            'cons-top':
+                "Number of client addresses published, with the highest" +
+                " max latency",
+            'wchs':
+                "Publish the watches summary of 'wchs'",
         })
         return config_help
 
@@ -63,27 +124,114 @@ class OpenioZookeeperCollector(diamond.collector.Collector):
 
             # Connection settings
             # 'instances': ['OPENIO:localhost:6005'],
+            'timeout': 5,
+            'threads': 5,
+            'cons': False,
+            'cons-top': 10,
+            'wchs': False,
         })
         return config
 
-    def get_raw_stats(self, host, port):
-        data = ''
+    def _iter_lines(self, host, port, command):
+        """Send a four letter command, and yield the lines of the reply as
+        they arrive, until the server closes the connection"""
+        timeout = float(self.config['timeout'])
+        deadline = time.time() + timeout
         # connect
+        if port is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
-            if port is None:
-                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-                sock.connect(host)
-            else:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.connect((host, int(port)))
+            sock.settimeout(timeout)
+            sock.connect(host if port is None else (host, int(port)))
             # request stats
-            sock.send('mntr\n')
-            # something big enough to get whatever is sent back
-            data = sock.recv(4096)
-        except socket.error:
-            self.log.exception('Failed to get stats from %s:%s',
-                               host, port)
-        return data
+            sock.sendall(command.encode('ascii') + b'\n')
+            pending = b''
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise socket.timeout('%s reply not complete after %ss' %
+                                         (command, timeout))
+                sock.settimeout(remaining)
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                lines = (pending + chunk).split(b'\n')
+                pending = lines.pop()
+                for line in lines:
+                    yield line.decode('utf-8', 'replace')
+            if pending:
+                yield pending.decode('utf-8', 'replace')
+        finally:
+            sock.close()
+
+    def _failed(self, host, port, command, exc):
+        if isinstance(exc, socket.timeout):
+            self.log.error('Failed to get %s from %s:%s: %s',
+                           command, host, port, exc)
+            self.count('timeouts')
+        else:
+            self.log.exception('Failed to get %s from %s:%s',
+                               command, host, port)
+            self.count('errors')
+
+    def get_raw_stats(self, host, port, command='mntr'):
+        try:
+            return '\n'.join(self._iter_lines(host, port, command))
+        except socket.error as exc:
+            self._failed(host, port, command, exc)
+            return ''
+
+    def _get_clients(self, host, port):
+        """Return the connections, average and max latencies by client
+        address, of the cons-top addresses with the highest max latency"""
+        # address -> [connections, sum of avglat, max of maxlat]
+        clients = {}
+        try:
+            for line in self._iter_lines(host, port, 'cons'):
+                match = self.CONS_RE.match(line)
+                if match is None:
+                    continue
+                avglat = self.AVGLAT_RE.search(match.group(2))
+                maxlat = self.MAXLAT_RE.search(match.group(2))
+                if avglat is None or maxlat is None:
+                    # the connection of the cons command itself
+                    continue
+                client = clients.get(match.group(1))
+                if client is None:
+                    client = clients[match.group(1)] = [0, 0, 0]
+                client[0] += 1
+                client[1] += int(avglat.group(1))
+                client[2] = max(client[2], int(maxlat.group(1)))
+        except socket.error as exc:
+            self._failed(host, port, 'cons', exc)
+            return {}
+
+        stats = {'zk_client_addresses': len(clients)}
+        top = sorted(clients.items(), key=lambda item: -item[1][2])
+        for address, (connections, avglat, maxlat) in \
+                top[:int(self.config['cons-top'])]:
+            key = 'clients.%s.' % re.sub(r'[.:]', '_', address)
+            stats[key + 'connections'] = connections
+            stats[key + 'avg_latency'] = avglat // connections
+            stats[key + 'max_latency'] = maxlat
+        return stats
+
+    def _get_watches(self, host, port):
+        stats = {}
+        try:
+            for line in self._iter_lines(host, port, 'wchs'):
+                match = self.WCHS_RE.match(line)
+                if match is not None:
+                    stats['zk_watching_connections'] = int(match.group(1))
+                    stats['zk_watched_paths'] = int(match.group(2))
+                match = self.TOTAL_WATCHES_RE.match(line)
+                if match is not None:
+                    stats['zk_total_watches'] = int(match.group(1))
+        except socket.error as exc:
+            self._failed(host, port, 'wchs', exc)
+        return stats
 
     def _get_stats(self, host, port):
         # stuff that's always ignored, aren't 'stats'
@@ -95,24 +243,95 @@ class OpenioZookeeperCollector(diamond.collector.Collector):
         # parse stats
         for line in data.splitlines():
             pieces = line.split()
+            if len(pieces) < 2:
+                continue
+            if pieces[0] == 'zk_server_state':
+                role = self.ROLES.get(pieces[1])
+                if role is not None:
+                    stats['zk_server_role'] = role
+                    stats['zk_is_leader'] = int(pieces[1] in ('leader',
+                                                              'standalone'))
             if pieces[0] in ignored:
                 continue
-            stats[pieces[0]] = pieces[1]
+            value = parse_number(pieces[1])
+            if value is not None:
+                stats[pieces[0]] = value
 
         # get max connection limit
         return stats
 
+    def fetch_instance(self, hostname, port):
+        """Fetch the stats of an instance, from a worker thread"""
+        endpoint = '%s:%s' % (hostname, port)
+        with self.phase('fetch'):
+            stats = self._get_stats(hostname, port)
+        if not stats:
+            self.breakers.failure(endpoint)
+            return None
+        self.breakers.success(endpoint)
+        now = time.time()
+        with self.phase('fetch'):
+            if str_to_bool(self.config['cons']):
+                stats.update(self._get_clients(hostname, port))
+            if str_to_bool(self.config['wchs']):
+                stats.update(self._get_watches(hostname, port))
+        return now, stats
+
+    def discover_extra(self, namespace, conf):
+        """Return the members of the ensemble of the namespace"""
+        return [addr.strip()
+                for addr in re.split(r'[,;]', conf.get('zookeeper') or '')
+                if addr.strip()]
+
+    def _add_derived(self, endpoint, stats, now):
+        """Add the rates and trends computed from the previous sample"""
+        for key in self.RATES:
+            if key in stats:
+                rate = self.series.rate(endpoint + key, stats[key], now)
+                if rate is not None:
+                    stats[key + '_per_sec'] = round(rate, 2)
+        if 'zk_outstanding_requests' in stats:
+            previous = self.series.swap(endpoint + 'zk_outstanding_requests',
+                                        stats['zk_outstanding_requests'], now)
+            if previous is not None:
+                stats['zk_outstanding_requests_delta'] = \
+                    stats['zk_outstanding_requests'] - int(previous[0])
+
+    @monitored
     def collect(self):
-        instances = self.config.get('instances')
+        instances = self.instances
 
         # Convert a string config value to be an array
         if isinstance(instances, basestring):
             instances = instances.split(',')
+        instances = [tuple(instance.strip().split(':'))
+                     for instance in instances if instance.strip()]
+        with self.phase('discovery'):
+            known = set(instance[1:] for instance in instances)
+            for namespace, hostname, port in self.discover():
+                if (hostname, str(port)) not in known:
+                    known.add((hostname, str(port)))
+                    instances.append((namespace, hostname, str(port)))
 
-        for instance in instances:
-            namespace, hostname, port = instance.split(':')
+        jobs = []
+        for namespace, hostname, port in instances:
+            endpoint = '%s:%s' % (hostname, port)
+            if not self.allow(endpoint):
+                continue
+            jobs.append(((namespace, hostname, port), self.fetch_instance,
+                         (hostname, port)))
 
-            stats = self._get_stats(hostname, port)
+        # a stuck instance shall not hold the others, each of the commands
+        # sent one after the other being allowed the timeout
+        commands = 1 + str_to_bool(self.config['cons']) + \
+            str_to_bool(self.config['wchs'])
+        deadline = float(self.config['timeout']) * commands + 1
+        for (namespace, hostname, port), result in self.fanout.run(
+                jobs, timeout=deadline):
+            if result is None:
+                continue
+            now, stats = result
+            self._add_derived('%s:%s.' % (hostname, port), stats, now)
 
             prefix = '%s.zookeeper.%s:%s.' % (namespace,
                                               hostname.replace('.', '_'),
@@ -124,9 +343,11 @@ class OpenioZookeeperCollector(diamond.collector.Collector):
             # for everything we want
             for stat in desired:
                 if stat in stats:
-                    self.publish(prefix + stat, stats[stat])
+                    self.batch(prefix + stat, stats[stat])
                 else:
                     # we don't, must be somehting configured in publish so we
                     # should log an error about it
                     self.log.error("No such key '%s' available, issue 'stats' "
                                    "for a full list", stat)
+        # forget the instances gone for a few cycles
+        self.series.expire(time.time() - 3 * float(self.config['interval']))
@@ -0,0 +1,75 @@
+# coding=utf-8
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'collectors', 'openio'))
+
+from openioredisstat import OpenioRedisCollector  # noqa: E402
+
+
+def entry(entry_id, command=b'GET key', duration=100):
+    return {'id': entry_id, 'command': command, 'duration': duration}
+
+
+class TestSlowlogData(unittest.TestCase):
+
+    def setUp(self):
+        config = {
+            'collectors': {
+                'default': {},
+                'OpenioRedisCollector': {'slowlog-top': 1},
+            },
+        }
+        self.collector = OpenioRedisCollector(config=config, handlers=[])
+
+    def slowlog(self, *entries):
+        return self.collector._slowlog_data('redis', list(entries))
+
+    def test_first_cycle(self):
+        # Only where the slowlog is, not what was logged before
+        self.assertEqual(self.slowlog(entry(5), entry(4)), {})
+        self.assertEqual(self.slowlog(entry(6), entry(5))['slowlog.count'],
+                         1)
+
+    def test_empty_then_entries(self):
+        self.assertEqual(self.slowlog(), {})
+        self.assertEqual(self.slowlog(), {'slowlog.count': 0})
+        data = self.slowlog(entry(1, duration=30), entry(0, duration=10))
+        self.assertEqual(data['slowlog.count'], 2)
+        self.assertEqual(data['slowlog.get.count'], 2)
+        self.assertEqual(data['slowlog.get.max'], 30)
+
+    def test_gap(self):
+        self.slowlog(entry(3))
+        # Entries 4 to 9 were pushed out of the slowlog before being read
+        data = self.slowlog(entry(12), entry(11), entry(10))
+        self.assertEqual(data['slowlog.count'], 9)
+        self.assertEqual(data['slowlog.get.count'], 3)
+
+    def test_restart(self):
+        self.slowlog(entry(40))
+        data = self.slowlog(entry(1), entry(0))
+        self.assertEqual(data['slowlog.count'], 2)
+        self.assertEqual(data['slowlog.get.count'], 2)
+        self.assertEqual(self.slowlog(entry(1))['slowlog.count'], 0)
+
+    def test_top(self):
+        self.slowlog()
+        data = self.slowlog(entry(3, b'SET key value', 5),
+                            entry(2, b'GET key', 50),
+                            entry(1, b'HGETALL key', 70),
+                            entry(0, b'GET key', 10))
+        self.assertEqual(data['slowlog.count'], 4)
+        self.assertEqual(data['slowlog.get.count'], 2)
+        self.assertEqual(data['slowlog.get.p50'], 10)
+        self.assertEqual(data['slowlog.get.max'], 50)
+        self.assertEqual(data['slowlog.other.count'], 2)
+        self.assertEqual(data['slowlog.other.max'], 70)
+        self.assertNotIn('slowlog.set.count', data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+# coding=utf-8
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'collectors', 'openio'))
+
+from openioutils import CircuitBreakers, MetricNames, SeriesStore, \
+    SharedCache, iter_stat_lines  # noqa: E402
+
+
+class TestSeriesStore(unittest.TestCase):
+
+    def test_rate(self):
+        series = SeriesStore()
+        self.assertIsNone(series.rate('OPENIO.rawx.a.req', 10, 100.0))
+        self.assertEqual(series.rate('OPENIO.rawx.a.req', 30, 110.0), 2.0)
+        # reset of the counter
+        self.assertIsNone(series.rate('OPENIO.rawx.a.req', 5, 120.0))
+
+    def test_unicode_name(self):
+        # Names built from the addresses of a JSON listing are unicode on
+        # Python 2, where they cannot be interned
+        series = SeriesStore()
+        name = u'OPENIO.rawx.127_0_0_1:6200.req.hits'
+        self.assertIsNone(series.swap(name, 1, 100.0))
+        self.assertEqual(series.get(name), (1.0, 100.0))
+        self.assertEqual(series.rate(name, 11, 110.0), 1.0)
+
+    def test_expire(self):
+        series = SeriesStore()
+        series.set('old', 1, 100.0)
+        series.set(u'new', 1, 200.0)
+        self.assertEqual(series.expire(150.0), 1)
+        self.assertIsNone(series.get('old'))
+        series.set('other', 2, 300.0)
+        self.assertEqual(len(series), 2)
+
+
+class TestCircuitBreakers(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.breakers = CircuitBreakers(2, 10, 30, clock=lambda: self.now)
+
+    def test_transitions(self):
+        breakers = self.breakers
+        breakers.failure('a')
+        self.assertTrue(breakers.allow('a'))
+        self.assertEqual(breakers.states(), {'a': CircuitBreakers.CLOSED})
+        breakers.failure('a')
+        self.assertFalse(breakers.allow('a'))
+        self.assertEqual(breakers.states(), {'a': CircuitBreakers.OPEN})
+        self.now += 10
+        # A single attempt once the backoff elapsed
+        self.assertTrue(breakers.allow('a'))
+        self.assertFalse(breakers.allow('a'))
+        self.assertEqual(breakers.states(), {'a': CircuitBreakers.HALF_OPEN})
+        # The backoff doubles on failure, up to max_backoff
+        breakers.failure('a')
+        self.now += 19
+        self.assertFalse(breakers.allow('a'))
+        self.now += 1
+        self.assertTrue(breakers.allow('a'))
+        breakers.failure('a')
+        self.now += 30
+        self.assertTrue(breakers.allow('a'))
+        breakers.success('a')
+        self.assertTrue(breakers.allow('a'))
+        self.assertEqual(breakers.states(), {'a': CircuitBreakers.CLOSED})
+        self.assertEqual(breakers.states(), {})
+
+    def test_forget(self):
+        breakers = self.breakers
+        breakers.failure('a')
+        breakers.failure('a')
+        breakers.failure('b')
+        breakers.failure('b')
+        self.now += 20
+        self.assertTrue(breakers.allow('a'))
+        self.now += 15
+        # 'b' was not called for longer than max_backoff
+        self.assertEqual(breakers.states(), {'a': CircuitBreakers.HALF_OPEN})
+        self.assertTrue(breakers.allow('b'))
+
+
+class TestIterStatLines(unittest.TestCase):
+
+    BODY = ('counter req.hits 5\r\n'
+            'gauge cnx.client 1.5e3\n'
+            'config volume /var/lib/oio/sds\r\n'
+            'counter req.time .25')
+    EXPECTED = [('OPENIO.rawx.a.req.hits', 5, 'COUNTER', None),
+                ('OPENIO.rawx.a.cnx.client', 1500.0, 'GAUGE', None),
+                ('OPENIO.rawx.a.req.time', 0.25, 'COUNTER', None)]
+
+    def test_chunks(self):
+        body = self.BODY
+        self.assertEqual(
+            list(iter_stat_lines((body,), 'OPENIO.rawx.a.')), self.EXPECTED)
+        for i in range(len(body) + 1):
+            chunks = (body[:i], body[i:])
+            self.assertEqual(
+                list(iter_stat_lines(chunks, 'OPENIO.rawx.a.')),
+                self.EXPECTED, "split at %d" % i)
+
+    def test_bytes(self):
+        chunks = [self.BODY[i:i + 3].encode('utf-8')
+                  for i in range(0, len(self.BODY), 3)]
+        self.assertEqual(list(iter_stat_lines(chunks, 'OPENIO.rawx.a.')),
+                         self.EXPECTED)
+
+
+class TestMetricNames(unittest.TestCase):
+
+    def test_names(self):
+        names = MetricNames('servers.host.openio.', u'OPENIO.rawx.a.')
+        found = names['req.hits']
+        self.assertEqual(found, ('OPENIO.rawx.a.req.hits',
+                                 'servers.host.openio.OPENIO.rawx.a.req.hits'))
+        self.assertIs(names['req.hits'], found)
+        self.assertEqual(names.misses, 1)
+        # ASCII names are not kept as unicode on Python 2
+        self.assertIs(type(found[0]), str)
+        self.assertIs(type(found[1]), str)
+
+    def test_render(self):
+        names = MetricNames('', 'OPENIO.beanstalkd.a.',
+                            render=lambda prefix, key: prefix + '.'.join(key))
+        self.assertEqual(names[('tubes', 'oio')][0],
+                         'OPENIO.beanstalkd.a.tubes.oio')
+
+    def test_size(self):
+        names = MetricNames('', 'OPENIO.', size=2)
+        names['a'], names['b'], names['c']
+        self.assertEqual(sorted(names), ['c'])
+        self.assertEqual(names.misses, 3)
+
+
+class TestSharedCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def test_shared(self):
+        cache = SharedCache(os.path.join(self.tmp, 'openio'), 60)
+        self.assertEqual(cache.get('key', lambda: [1]), [1])
+        self.assertEqual(cache.get('key', lambda: [2]), [1])
+        self.assertEqual(
+            os.stat(os.path.join(self.tmp, 'openio')).st_mode & 0o777,
+            0o700)
+
+    def test_writable_by_others(self):
+        os.chmod(self.tmp, 0o777)
+        cache = SharedCache(self.tmp, 60)
+        self.assertEqual(cache.get('key', lambda: [1]), [1])
+        self.assertEqual(cache.get('key', lambda: [2]), [2])
+        self.assertEqual(os.listdir(self.tmp), [])
+
+    def test_symlink(self):
+        target = os.path.join(self.tmp, 'target')
+        os.mkdir(target, 0o700)
+        os.symlink(target, os.path.join(self.tmp, 'openio'))
+        cache = SharedCache(os.path.join(self.tmp, 'openio'), 60)
+        self.assertEqual(cache.get('key', lambda: [1]), [1])
+        self.assertEqual(os.listdir(target), [])
+
+    def test_lock_symlink(self):
+        cache = SharedCache(self.tmp, 60)
+        target = os.path.join(self.tmp, 'target')
+        os.symlink(target, os.path.join(self.tmp, 'key.json.lock'))
+        self.assertEqual(cache.get('key', lambda: [1]), [1])
+        self.assertFalse(os.path.exists(target))
+
+
+if __name__ == '__main__':
+    unittest.main()